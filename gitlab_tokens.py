@@ -1,43 +1,876 @@
 import requests
 import datetime
+import hashlib
 import os
 import logging
 from datetime import timezone
 import traceback
-import boto3
+import uuid
 import json
-from botocore.exceptions import ClientError
+import copy
+import math
+import queue
+import random
+import sys
+import threading
+import time
+from bisect import bisect_left
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass
+from functools import partial
+from urllib.parse import quote, urlsplit
+from requests.adapters import HTTPAdapter
+from typing import TypedDict
 
-GITLAB_BASE_URL = "https://5d27-2a02-a31a-c282-5880-398e-decf-f98c-1079.ngrok-free.app"
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+GITLAB_BASE_URL = os.environ.get("GITLAB_BASE_URL", "https://5d27-2a02-a31a-c282-5880-398e-decf-f98c-1079.ngrok-free.app")
 GITLAB_API_URL = f"{GITLAB_BASE_URL}/api/v4"
 GITLAB_ADMIN_TOKEN = os.environ.get("GITLAB_ADMIN_TOKEN")
 SQS_QUEUE_URL = os.environ.get("SQS_QUEUE_URL")
+SHARD_QUEUE_URL = os.environ.get("SHARD_QUEUE_URL") or SQS_QUEUE_URL
 SLACK_WEBHOOK_URL = os.environ.get("SLACK_WEBHOOK_URL")
+# JSON list of {"name", "url", "token_env" or "token_secret", "max_workers", "rate_limit_rps", "root_groups"}
+# to scan together.
+GITLAB_INSTANCES = json.loads(os.environ.get("GITLAB_INSTANCES") or "[]")
 
-if not GITLAB_ADMIN_TOKEN:
-    raise EnvironmentError("Missing GITLAB_ADMIN_TOKEN environment variable")
-
-HEADERS = {"PRIVATE-TOKEN": GITLAB_ADMIN_TOKEN}
 EXPIRY_THRESHOLD_DAYS = 30
 WARNING_THRESHOLD_DAYS = 7
+# Ascending days-left limits; a token falls in the first bucket it fits.
+SEVERITY_THRESHOLDS = ((-1, "expired"), (WARNING_THRESHOLD_DAYS, "critical"), (EXPIRY_THRESHOLD_DAYS, "warning"))
+MAX_WORKERS = int(os.environ.get("GITLAB_MAX_WORKERS", "8"))
+REQUEST_TIMEOUT = float(os.environ.get("GITLAB_REQUEST_TIMEOUT", "5"))
+# Client-side pacing in requests/s; 0 (the default) sends as fast as the workers go and relies on the
+# RateLimit-Remaining/Reset pause and 429 back-off to stay inside the instance's own limits.
+RATE_LIMIT_RPS = float(os.environ.get("GITLAB_RATE_LIMIT_RPS", "0"))
+RATE_LIMIT_RESERVE = int(os.environ.get("GITLAB_RATE_LIMIT_RESERVE", "10"))
+MAX_RETRIES = int(os.environ.get("GITLAB_MAX_RETRIES", "5"))
+BACKOFF_BASE = float(os.environ.get("GITLAB_BACKOFF_BASE", "0.5"))
+BACKOFF_MAX = float(os.environ.get("GITLAB_BACKOFF_MAX", "30"))
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+PER_PAGE = 100
+JSON_DECODER = os.environ.get("JSON_DECODER", "auto").lower()
+FETCH_BACKEND = os.environ.get("FETCH_BACKEND", "rest").lower()
+# Each alias carries a nested members connection; 10 keeps a batch inside GitLab's default query complexity limit.
+GRAPHQL_BATCH_SIZE = int(os.environ.get("GRAPHQL_BATCH_SIZE", "10"))
+KEYSET_ENDPOINTS = {"projects"}
+PREFETCH_ENDPOINTS = {"groups", "personal_access_tokens"}
+PROJECT_FIELDS = ("id", "path_with_namespace")
+GROUP_FIELDS = ("id", "full_path")
+LISTING_PATH_FIELDS = {"projects": "path_with_namespace", "groups": "full_path"}
+PROJECT_LIST_PARAMS = {"archived": "false"}
+# Group ids or full paths; when set, only these groups and everything below them are scanned.
+ROOT_GROUPS = [group.strip() for group in os.environ.get("ROOT_GROUPS", "").split(",") if group.strip()]
+if os.environ.get("PROJECT_MIN_ACCESS_LEVEL"):
+    PROJECT_LIST_PARAMS["min_access_level"] = os.environ["PROJECT_MIN_ACCESS_LEVEL"]
+SKIP_USER_NAMESPACES = os.environ.get("SKIP_USER_NAMESPACES", "true").lower() == "true"
+DENYLIST_FILE = os.environ.get("DENYLIST_FILE")
+DENYLIST_TTL_DAYS = int(os.environ.get("DENYLIST_TTL_DAYS", "7"))
+CHECKPOINT_STORE = os.environ.get("CHECKPOINT_STORE")
+INCREMENTAL_SCAN = os.environ.get("INCREMENTAL_SCAN", "false").lower() == "true"
+FULL_SCAN_INTERVAL_HOURS = float(os.environ.get("FULL_SCAN_INTERVAL_HOURS", "168"))
+CHECKPOINT_KEY = "checkpoint.json"
+DENYLIST_KEY = "denylist.json"
+RESPONSE_CACHE = os.environ.get("RESPONSE_CACHE")
+RESPONSE_CACHE_SIZE = int(os.environ.get("RESPONSE_CACHE_SIZE", "50000"))
+RESPONSE_CACHE_KEY = "response_cache.json"
+LISTING_CACHE_TTL = float(os.environ.get("LISTING_CACHE_TTL", "0"))
+LISTING_CACHE_SIZE = int(os.environ.get("LISTING_CACHE_SIZE", "200000"))
+DEADLINE_MARGIN_MS = int(os.environ.get("DEADLINE_MARGIN_MS", "60000"))
+RUN_STATE_PREFIX = "runs/"
+SCAN_MODE = os.environ.get("SCAN_MODE", "single").lower()
+SHARD_SIZE = int(os.environ.get("SHARD_SIZE", "500"))
+PARTITION_SIZE = int(os.environ.get("PARTITION_SIZE", "200"))
+ENTITY_LABELS = {"projects": "Project", "groups": "Group"}
+SCAN_PHASES = ("personal_tokens", "project_tokens", "group_tokens")
+TREE_PHASES = ("group_tree",)
+PHASE_BANNERS = {
+    "project_tokens": "\n--- Project Tokens ---\n",
+    "group_tokens": "\n--- Group Tokens ---\n",
+    "group_tree": "\n--- Group Tree Tokens ---\n",
+}
+METRICS_EMF = os.environ.get("METRICS_EMF", "false").lower() == "true"
+METRICS_NAMESPACE = os.environ.get("METRICS_NAMESPACE", "GitLabTokenChecker")
+LATENCY_BUCKETS_MS = tuple(round(1.25 ** i, 2) for i in range(50))
+TOKEN_SUMMARY_FIELDS = ("id", "name", "scopes", "expires_at", "created_at", "last_used_at")
+CACHED_TOKEN_FIELDS = TOKEN_SUMMARY_FIELDS + ("revoked", "active")
+# Slack allows 50 blocks per message and 3000 characters per section, and truncates messages past 40k
+# characters; SQS takes 256 KiB per message and per batch.
+SLACK_MAX_BLOCKS = 50
+SLACK_SECTION_CHARS = 3000
+SLACK_MESSAGE_CHARS = 30000
+SQS_MAX_BYTES = 256 * 1024
+SQS_BATCH_ENTRIES = 10
+DELIVERY_WORKERS = int(os.environ.get("DELIVERY_WORKERS", "4"))
+DELIVERY_RETRIES = int(os.environ.get("DELIVERY_RETRIES", "3"))
 
 LOGLEVEL = os.environ.get('LOGLEVEL', 'INFO').upper()
 logging.basicConfig(level=LOGLEVEL, format="%(message)s")
 logger = logging.getLogger(__name__)
 
-sqs_client = boto3.client("sqs")
-seen_tokens = {}
-tokens_printed = 0
-expiring_tokens = []
 
-api_failed = True
+def default_headers():
+    # Checked on first use rather than at import, so tooling can import the module without a token.
+    if not GITLAB_ADMIN_TOKEN:
+        raise EnvironmentError("Missing GITLAB_ADMIN_TOKEN environment variable")
+    return {"PRIVATE-TOKEN": GITLAB_ADMIN_TOKEN}
+
+
+def token_fingerprint(headers):
+    token = headers.get("PRIVATE-TOKEN") or headers.get("Authorization") or ""
+    return hashlib.sha256(token.encode()).hexdigest()[:16]
+
+
+_aws_clients = {}
+_aws_lock = threading.Lock()
+
+
+def aws_client(service):
+    """boto3 client for service; boto3 is imported on first use and clients are kept across warm invocations."""
+    with _aws_lock:
+        if service not in _aws_clients:
+            import boto3
+            _aws_clients[service] = boto3.client(service)
+        return _aws_clients[service]
+
+
+def endpoint_name(url):
+    path = urlsplit(url).path
+    path = path.split("/api/v4/", 1)[-1].split("/api/", 1)[-1]
+    return "/".join(":id" if part.isdigit() else part for part in path.split("/"))
+
+
+class Histogram:
+    """Fixed log-scale latency buckets; percentiles resolve to a bucket's upper bound."""
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        self.total = 0
+
+    def add(self, value_ms):
+        self.counts[bisect_left(LATENCY_BUCKETS_MS, value_ms)] += 1
+        self.total += 1
+
+    def percentile(self, pct):
+        if not self.total:
+            return None
+        rank = math.ceil(pct / 100 * self.total)
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return LATENCY_BUCKETS_MS[min(index, len(LATENCY_BUCKETS_MS) - 1)]
+
+    def summary(self):
+        return {"p50": self.percentile(50), "p95": self.percentile(95), "p99": self.percentile(99)}
+
+    def merge(self, counts):
+        self.counts = [mine + theirs for mine, theirs in zip(self.counts, counts)]
+        self.total += sum(counts)
+
+
+class Metrics:
+    """Per-run phase timings and request statistics."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.phases = {}
+        self.endpoints = {}
+        self.latency = Histogram()
+        self.requests = 0
+        self.retries = 0
+        self.bytes_received = 0
+
+    @contextmanager
+    def phase(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            # Accumulates, so a phase split across resumed invocations reports its total time.
+            self.phases[name] = round(self.phases.get(name, 0) + time.perf_counter() - started, 3)
+
+    def observe(self, url, seconds, size):
+        name = endpoint_name(url)
+        latency_ms = seconds * 1000
+        with self.lock:
+            self.requests += 1
+            self.bytes_received += size
+            self.latency.add(latency_ms)
+            endpoint = self.endpoints.get(name)
+            if endpoint is None:
+                endpoint = self.endpoints[name] = {"requests": 0, "latency": Histogram()}
+            endpoint["requests"] += 1
+            endpoint["latency"].add(latency_ms)
+
+    def retried(self):
+        with self.lock:
+            self.retries += 1
+
+    def export(self):
+        """Raw counters, for merging another process's metrics into a run."""
+        with self.lock:
+            return {
+                "requests": self.requests,
+                "retries": self.retries,
+                "bytes_received": self.bytes_received,
+                "phases": dict(self.phases),
+                "latency": list(self.latency.counts),
+                "endpoints": {
+                    name: {"requests": endpoint["requests"], "latency": list(endpoint["latency"].counts)}
+                    for name, endpoint in self.endpoints.items()
+                },
+            }
+
+    def merge(self, data):
+        with self.lock:
+            self.requests += data["requests"]
+            self.retries += data["retries"]
+            self.bytes_received += data["bytes_received"]
+            for name, seconds in data.get("phases", {}).items():
+                self.phases[name] = round(self.phases.get(name, 0) + seconds, 3)
+            self.latency.merge(data["latency"])
+            for name, theirs in data["endpoints"].items():
+                endpoint = self.endpoints.get(name)
+                if endpoint is None:
+                    endpoint = self.endpoints[name] = {"requests": 0, "latency": Histogram()}
+                endpoint["requests"] += theirs["requests"]
+                endpoint["latency"].merge(theirs["latency"])
+
+    def summary(self, **extra):
+        return {
+            "phases_s": dict(self.phases),
+            "requests": self.requests,
+            "retries": self.retries,
+            "bytes_received": self.bytes_received,
+            "latency_ms": self.latency.summary(),
+            "endpoints": {
+                name: {"requests": endpoint["requests"], **endpoint["latency"].summary()}
+                for name, endpoint in sorted(self.endpoints.items())
+            },
+            **extra,
+        }
+
+
+def emit_emf(summary):
+    values = {f"{name}_s": seconds for name, seconds in summary["phases_s"].items()}
+    values.update({
+        "requests": summary["requests"],
+        "retries": summary["retries"],
+        "bytes_received": summary["bytes_received"],
+        "entities_skipped": summary.get("entities_skipped", 0),
+        "latency_p95_ms": summary["latency_ms"]["p95"] or 0,
+    })
+    if summary.get("response_cache"):
+        cache = summary["response_cache"]
+        values.update({
+            "cache_hits": cache["hits"],
+            "cache_misses": cache["misses"],
+            "cache_bytes_saved": cache["bytes_saved"],
+        })
+    units = {"_s": "Seconds", "_ms": "Milliseconds", "bytes_received": "Bytes", "bytes_saved": "Bytes"}
+    print(json.dumps({
+        "_aws": {
+            "Timestamp": int(time.time() * 1000),
+            "CloudWatchMetrics": [{
+                "Namespace": METRICS_NAMESPACE,
+                "Dimensions": [[]],
+                "Metrics": [
+                    {"Name": name, "Unit": next((unit for suffix, unit in units.items() if name.endswith(suffix)), "Count")}
+                    for name in values
+                ],
+            }],
+        },
+        **values,
+    }))
+
+
+class RateLimiter:
+    """Token bucket shared by every worker thread talking to one GitLab instance."""
+
+    def __init__(self, rate=RATE_LIMIT_RPS, burst=MAX_WORKERS):
+        self.rate = rate
+        self.capacity = max(burst, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if not self.rate:
+            self._wait_for_pause()
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now >= self.paused_until:
+                    self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+                else:
+                    wait = self.paused_until - now
+            time.sleep(wait)
+
+    def _wait_for_pause(self):
+        wait = self.paused_until - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0
+
+    def observe(self, headers):
+        remaining = headers.get("RateLimit-Remaining")
+        reset = headers.get("RateLimit-Reset")
+        if remaining is None or reset is None:
+            return
+        if int(remaining) <= RATE_LIMIT_RESERVE:
+            seconds = float(reset) - time.time()
+            if seconds > 0:
+                logger.warning(f"GitLab rate limit almost exhausted, pausing {seconds:.1f}s until reset")
+                self.pause(seconds)
+
+
+def retry_delay(resp, attempt):
+    retry_after = resp.headers.get("Retry-After") if resp is not None else None
+    if retry_after is not None:
+        try:
+            return float(retry_after)
+        except ValueError:
+            pass
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+class NamespaceEntry(TypedDict, total=False):
+    kind: str | None
+
+
+class ProjectEntry(TypedDict, total=False):
+    id: int
+    path_with_namespace: str
+    namespace: NamespaceEntry | None
+
+
+class GroupEntry(TypedDict, total=False):
+    id: int
+    full_path: str
+
+
+# Listing pages msgspec decodes into slim dicts holding only the fields the checker reads.
+PAGE_SCHEMAS = {
+    "projects": list[ProjectEntry],
+    "groups": list[GroupEntry],
+    "groups/:id/descendant_groups": list[GroupEntry],
+    "groups/:id/projects": list[ProjectEntry],
+}
+DECODE_ERRORS = (msgspec.DecodeError,) if msgspec else ()
+_decoders = {}
+
+
+def json_backend(backend=None):
+    backend = backend or JSON_DECODER
+    if backend == "auto":
+        return "msgspec" if msgspec else "orjson" if orjson else "json"
+    return backend
+
+
+def page_decoder(endpoint=None, backend=None):
+    backend = json_backend(backend)
+    endpoint = endpoint_name(endpoint) if endpoint else None
+    key = (backend, endpoint if backend == "msgspec" else None)
+    try:
+        return _decoders[key]
+    except KeyError:
+        pass
+    if backend == "msgspec":
+        schema = PAGE_SCHEMAS.get(endpoint)
+        decode = (msgspec.json.Decoder(schema) if schema else msgspec.json.Decoder()).decode
+    elif backend == "orjson":
+        decode = orjson.loads
+    else:
+        decode = json.loads
+    return _decoders.setdefault(key, decode)
+
+
+def decode_json(resp, endpoint=None, backend=None):
+    """Decode a response body straight from its bytes with the fastest available backend."""
+    try:
+        return page_decoder(endpoint, backend)(resp.content)
+    except DECODE_ERRORS as e:
+        raise ValueError(f"Invalid JSON response: {e}") from e
+
+
+class GitLabClient:
+    """Pooled keep-alive session shared by every GitLab API call."""
+
+    def __init__(self, api_url, headers, timeout=REQUEST_TIMEOUT, pool_size=None, limiter=None, metrics=None):
+        # Token fetchers and the listing prefetch run side by side, so size for both.
+        pool_size = pool_size or 2 * MAX_WORKERS
+        self.api_url = api_url
+        self.graphql_url = f"{api_url.rsplit('/', 1)[0]}/graphql"
+        self.timeout = timeout
+        self.limiter = limiter or RateLimiter(burst=pool_size)
+        self.metrics = metrics or Metrics()
+        self.session = requests.Session()
+        self.session.headers.update(headers)
+        self.adapter = HTTPAdapter(pool_maxsize=pool_size)
+        self.session.mount("https://", self.adapter)
+        self.session.mount("http://", self.adapter)
+
+    def get(self, endpoint, params=None, timeout=None, headers=None):
+        url = endpoint if endpoint.startswith(("http://", "https://")) else f"{self.api_url}/{endpoint}"
+        if headers:
+            return self._send(self.session.get, url, timeout, params=params, headers=headers)
+        return self._send(self.session.get, url, timeout, params=params)
+
+    def graphql(self, query, variables=None, timeout=None):
+        payload = {"query": query, "variables": variables or {}}
+        return self._send(self.session.post, self.graphql_url, timeout, json=payload)
+
+    def _send(self, method, url, timeout, **kwargs):
+        for attempt in range(MAX_RETRIES + 1):
+            self.limiter.acquire()
+            started = time.perf_counter()
+            try:
+                resp = method(url, timeout=timeout or self.timeout, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == MAX_RETRIES:
+                    raise
+                resp = None
+            else:
+                self.metrics.observe(url, time.perf_counter() - started, len(resp.content))
+                self.limiter.observe(resp.headers)
+                if resp.status_code not in RETRY_STATUSES or attempt == MAX_RETRIES:
+                    return resp
+
+            delay = retry_delay(resp, attempt)
+            self.metrics.retried()
+            logger.warning(f"Retrying {url} in {delay:.1f}s (attempt {attempt + 1}/{MAX_RETRIES})")
+            if resp is not None and resp.status_code == 429:
+                # Throttling applies to the whole token, so hold back every worker.
+                self.limiter.pause(delay)
+            else:
+                time.sleep(delay)
+
+    def with_metrics(self, metrics):
+        """A view sharing this client's session, pool and limiter that records into its own metrics."""
+        view = copy.copy(self)
+        view.metrics = metrics
+        return view
+
+    def connection_stats(self, since=None):
+        """Pool counters; with since (an earlier result), only what happened after it."""
+        opened = sent = 0
+        pools = self.adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            opened += pool.num_connections
+            sent += pool.num_requests
+        if since:
+            # Counters live as long as the pooled client, which warm invocations keep.
+            sent = max(sent - since["requests"], 0)
+            opened = max(opened - since["connections_opened"], 0)
+        return {
+            "requests": sent,
+            "connections_opened": opened,
+            "connections_reused": max(sent - opened, 0),
+        }
+
+
+_gitlab_clients = {}
+_gitlab_clients_lock = threading.Lock()
+
+
+def gitlab_client(api_url, headers, max_workers, rate):
+    """GitLabClient per instance, token and budget; warm invocations keep its pooled connections and limiter."""
+    key = (api_url, hashlib.sha256(json.dumps(headers, sort_keys=True).encode()).hexdigest(), max_workers, rate)
+    with _gitlab_clients_lock:
+        if key not in _gitlab_clients:
+            _gitlab_clients[key] = GitLabClient(
+                api_url, headers, pool_size=2 * max_workers, limiter=RateLimiter(rate=rate, burst=max_workers)
+            )
+        return _gitlab_clients[key]
+
+
+class FileStore:
+    """JSON documents stored as files under a local directory."""
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _path(self, key):
+        return os.path.join(self.directory, key)
+
+    def get(self, key):
+        try:
+            with open(self._path(key)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def put(self, key, data):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(f"{path}.tmp", "w") as f:
+            json.dump(data, f)
+        os.replace(f"{path}.tmp", path)
+
+    def put_if_absent(self, key, data):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            with open(path, "x") as f:
+                json.dump(data, f)
+        except FileExistsError:
+            return False
+        return True
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+
+class S3Store:
+    """JSON documents stored as objects under an S3 bucket prefix."""
+
+    def __init__(self, bucket, prefix=""):
+        self.bucket = bucket
+        self.prefix = prefix.strip("/")
+        self.s3 = aws_client("s3")
+
+    def _key(self, key):
+        return f"{self.prefix}/{key}" if self.prefix else key
+
+    def get(self, key):
+        from botocore.exceptions import ClientError
+        try:
+            obj = self.s3.get_object(Bucket=self.bucket, Key=self._key(key))
+        except ClientError as error:
+            if error.response.get("Error", {}).get("Code") in ("NoSuchKey", "404"):
+                return None
+            raise
+        return json.loads(obj["Body"].read())
+
+    def put(self, key, data):
+        self.s3.put_object(Bucket=self.bucket, Key=self._key(key), Body=json.dumps(data).encode())
+
+    def put_if_absent(self, key, data):
+        from botocore.exceptions import ClientError
+        try:
+            self.s3.put_object(
+                Bucket=self.bucket, Key=self._key(key), Body=json.dumps(data).encode(), IfNoneMatch="*"
+            )
+        except ClientError as error:
+            if error.response.get("Error", {}).get("Code") in ("PreconditionFailed", "ConditionalRequestConflict"):
+                return False
+            raise
+        return True
+
+    def delete(self, key):
+        self.s3.delete_object(Bucket=self.bucket, Key=self._key(key))
+
+
+def open_store(location):
+    if not location:
+        return None
+    if location.startswith("s3://"):
+        bucket, _, prefix = location[len("s3://"):].partition("/")
+        return S3Store(bucket, prefix)
+    return FileStore(location)
+
+
+class LocalQueue:
+    """In-process stand-in for the SQS client, for running sharded scans without AWS."""
+
+    def __init__(self):
+        self.messages = deque()
+
+    def send_message(self, QueueUrl, MessageBody, MessageAttributes=None):
+        self.messages.append(MessageBody)
+        return {"MessageId": str(len(self.messages))}
+
+    def send_message_batch(self, QueueUrl, Entries):
+        self.messages.extend(entry["MessageBody"] for entry in Entries)
+        return {"Successful": [{"Id": entry["Id"]} for entry in Entries], "Failed": []}
+
+    def drain(self, handler, context=None):
+        results = []
+        while self.messages:
+            results.append(handler({"Records": [{"body": self.messages.popleft()}]}, context))
+        return results
+
+
+class ResponseCache:
+    """Size-bounded LRU of validators and compact bodies for conditional GETs, persisted in a store.
+
+    Keys combine the URL with a fingerprint of the token, since what an endpoint returns
+    depends on who asks.
+    """
+
+    def __init__(self, store, headers, max_entries=RESPONSE_CACHE_SIZE, key=RESPONSE_CACHE_KEY):
+        self.store = store
+        self.key = key
+        self.max_entries = max_entries
+        self.fingerprint = token_fingerprint(headers)
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.hits = self.misses = self.bytes_saved = self.evictions = 0
+
+    def load(self):
+        self.reset_stats()
+        data = self.store.get(self.key) or {}
+        self.entries = OrderedDict(
+            (key, entry) for key, entry in data.get("entries", []) if key.startswith(f"{self.fingerprint}:")
+        )
+
+    def save(self):
+        with self.lock:
+            entries = list(self.entries.items())
+        self.store.put(self.key, {"entries": entries})
+
+    def lookup(self, url):
+        with self.lock:
+            entry = self.entries.get(f"{self.fingerprint}:{url}")
+            if entry is not None:
+                self.entries.move_to_end(f"{self.fingerprint}:{url}")
+            return entry
+
+    def conditional_headers(self, entry):
+        headers = {}
+        if entry and entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry and entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def hit(self, entry):
+        with self.lock:
+            self.hits += 1
+            self.bytes_saved += entry["size"]
+        return entry["body"]
+
+    def remember(self, url, resp, body):
+        etag, last_modified = resp.headers.get("ETag"), resp.headers.get("Last-Modified")
+        with self.lock:
+            self.misses += 1
+            if not etag and not last_modified:
+                return
+            key = f"{self.fingerprint}:{url}"
+            self.entries[key] = {"etag": etag, "last_modified": last_modified, "size": len(resp.content), "body": body}
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def export(self, urls):
+        """Entries held for the given URLs, e.g. the part of the cache one shard refreshed."""
+        with self.lock:
+            keys = (f"{self.fingerprint}:{url}" for url in urls)
+            return [(key, self.entries[key]) for key in keys if key in self.entries]
+
+    def merge(self, entries):
+        with self.lock:
+            for key, entry in entries:
+                self.entries[key] = entry
+                self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "bytes_saved": self.bytes_saved,
+            "evictions": self.evictions,
+            "entries": len(self.entries),
+        }
+
+
+class ListingCache:
+    """In-process TTL cache of slim (id, path) project/group listings, kept by warm containers.
+
+    Listings are keyed by instance, token and query and stored as immutable tuples swapped
+    under a lock, so concurrent scanners only ever read complete snapshots of their own
+    instance. The TTL runs from the last full listing; in between, scanners only fetch the tail.
+    """
+
+    def __init__(self, ttl=None, max_entries=None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.listings = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        ttl = LISTING_CACHE_TTL if self.ttl is None else self.ttl
+        with self.lock:
+            listing = self.listings.get(key)
+        if listing is None or time.monotonic() - listing[0] >= ttl:
+            return None
+        return listing
+
+    def put(self, key, listed_at, entries):
+        max_entries = LISTING_CACHE_SIZE if self.max_entries is None else self.max_entries
+        with self.lock:
+            if len(entries) > max_entries:
+                self.listings.pop(key, None)
+                return
+            self.listings[key] = (listed_at, tuple(entries))
+
+    def clear(self):
+        with self.lock:
+            self.listings.clear()
+
+
+warm_listings = ListingCache()
+
+
+class ExpiryEvaluator:
+    """Buckets expires_at dates into severities against cutoffs computed once per run.
+
+    GitLab sends expires_at as YYYY-MM-DD, so each cutoff is kept as an ISO string and
+    compared directly; results are memoised per date string.
+    """
+
+    def __init__(self, thresholds=SEVERITY_THRESHOLDS, now=None):
+        now = now or datetime.datetime.now(timezone.utc)
+        self.today = now.date()
+        # days_left floors (midnight of expires_at - now), so after midnight a date
+        # d calendar days away has d - 1 days left.
+        self.offset = 0 if now.time() == datetime.time(0) else 1
+        self.cutoffs = tuple(
+            ((self.today + datetime.timedelta(days=days + self.offset)).isoformat(), severity)
+            for days, severity in sorted(thresholds)
+        )
+        self.cutoff = self.cutoffs[-1][0]
+        self._severities = {}
+
+    def days_left(self, expires_at):
+        if not expires_at or expires_at == "∞":
+            return None
+        return (datetime.date.fromisoformat(expires_at) - self.today).days - self.offset
+
+    def severity(self, expires_at):
+        try:
+            return self._severities[expires_at]
+        except KeyError:
+            pass
+        result = None
+        if expires_at and expires_at != "∞":
+            for cutoff, severity in self.cutoffs:
+                if expires_at <= cutoff:
+                    result = severity
+                    break
+        self._severities[expires_at] = result
+        return result
+
+
+_scope_tuples = {}
+
+
+def intern_scopes(scopes):
+    """Return one shared tuple of interned strings per distinct scope list."""
+    key = tuple(scopes or ())
+    try:
+        return _scope_tuples[key]
+    except KeyError:
+        return _scope_tuples.setdefault(key, tuple(sys.intern(scope) for scope in key))
+
+
+@dataclass(frozen=True, slots=True)
+class TokenRecord:
+    """The fields of an expiring token that reach the report; built straight from the API payload."""
+
+    id: int
+    name: str
+    scopes: tuple
+    expires: int
+    created_at: str
+    severity: str
+    source: str
+    url: str = None
+    instance: str = None
+
+    @classmethod
+    def from_token(cls, token, severity, source, url=None, instance=None):
+        return cls(
+            token.get("id"),
+            token.get("name"),
+            intern_scopes(token.get("scopes")),
+            datetime.date.fromisoformat(token["expires_at"]).toordinal(),
+            token.get("created_at"),
+            severity,
+            sys.intern(source),
+            url,
+            instance,
+        )
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(
+            data.get("id"),
+            data.get("name"),
+            intern_scopes(data.get("scopes")),
+            datetime.date.fromisoformat(data["expires_at"]).toordinal(),
+            data.get("created_at"),
+            data.get("severity"),
+            sys.intern(data.get("source") or "unknown"),
+            data.get("url"),
+            data.get("instance"),
+        )
+
+    @property
+    def expires_at(self):
+        return datetime.date.fromordinal(self.expires).isoformat()
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "name": self.name,
+            "scopes": list(self.scopes),
+            "expires_at": self.expires_at,
+            "created_at": self.created_at,
+            "severity": self.severity,
+            "source": self.source,
+            "url": self.url,
+            "instance": self.instance,
+        }
+
+
+# Replaced by tests and local runs (see LocalQueue); otherwise the boto3 SQS client is built on first send.
+sqs_client = None
 
 
 def send_message(queue_url, message_body, message_attributes=None):
+    from botocore.exceptions import ClientError
     if not message_attributes:
         message_attributes = {}
     try:
-        response = sqs_client.send_message(
+        response = (sqs_client or aws_client("sqs")).send_message(
             QueueUrl=queue_url,
             MessageBody=message_body,
             MessageAttributes=message_attributes
@@ -49,31 +882,158 @@ def send_message(queue_url, message_body, message_attributes=None):
         raise error
 
 
+def send_message_batch(queue_url, bodies):
+    """Send up to SQS_BATCH_ENTRIES bodies in one call, retrying the entries SQS failed on its side."""
+    from botocore.exceptions import ClientError
+    entries = {str(i): body for i, body in enumerate(bodies)}
+    for attempt in range(DELIVERY_RETRIES + 1):
+        try:
+            response = (sqs_client or aws_client("sqs")).send_message_batch(
+                QueueUrl=queue_url,
+                Entries=[{"Id": entry_id, "MessageBody": body} for entry_id, body in entries.items()],
+            )
+        except ClientError:
+            if attempt == DELIVERY_RETRIES:
+                logger.exception(f"Send message batch of {len(entries)} messages failed")
+                raise
+        else:
+            failed = response.get("Failed") or []
+            if not failed:
+                logger.info(f"{len(bodies)} messages sent to SQS")
+                return response
+            rejected = [f for f in failed if f.get("SenderFault")]
+            if rejected or attempt == DELIVERY_RETRIES:
+                reasons = ", ".join(f"{f['Id']}: {f.get('Message') or f.get('Code')}" for f in rejected or failed)
+                raise RuntimeError(f"SQS did not accept {len(rejected or failed)} messages ({reasons})")
+            entries = {f["Id"]: entries[f["Id"]] for f in failed}
+        time.sleep(retry_delay(None, attempt))
+
+
+def report_messages(summary, tokens, max_bytes=SQS_MAX_BYTES):
+    """Split a report into SQS bodies under max_bytes; every part repeats the summary and numbers itself."""
+    # Room for the envelope, the part numbers and the separators between tokens.
+    overhead = len(json.dumps({"summary": summary, "part": 0, "parts": 0, "tokens": []}).encode()) + 32
+    parts, part, size = [], [], overhead
+    for token in tokens:
+        data = token.to_dict()
+        token_size = len(json.dumps(data).encode()) + 2
+        if part and size + token_size > max_bytes:
+            parts.append(part)
+            part, size = [], overhead
+        part.append(data)
+        size += token_size
+    parts.append(part)
+    return [
+        json.dumps({"summary": summary, "part": number, "parts": len(parts), "tokens": part})
+        for number, part in enumerate(parts, 1)
+    ]
+
+
+def sqs_batches(bodies, max_bytes=SQS_MAX_BYTES):
+    batch, size = [], 0
+    for body in bodies:
+        body_size = len(body.encode())
+        if batch and (len(batch) == SQS_BATCH_ENTRIES or size + body_size > max_bytes):
+            yield batch
+            batch, size = [], 0
+        batch.append(body)
+        size += body_size
+    if batch:
+        yield batch
+
+
+def report_source(token):
+    return token.source if token.source in ENTITY_LABELS.values() else "Personal"
+
+
+def slack_section(text):
+    return {"type": "section", "text": {"type": "mrkdwn", "text": text}}
+
+
+def slack_messages(summary, tokens):
+    """Block Kit payloads for a report, split to stay within Slack's section, block and message limits.
+
+    Tokens get one section per source, under a header per instance when several were scanned.
+    """
+    instances = summary.get("instances")
+    failed = sorted(name for name, instance in (instances or {}).items() if instance["status"] == "error")
+    failure_note = f"❌ *Not checked, the scan failed:* {', '.join(failed)}"
+    if not tokens and failed:
+        return [{
+            "text": f"⚠️ *No expiring tokens on the instances that were scanned.* "
+                    f"Checked: {summary['tokens_checked']} at {summary['timestamp']}\n{failure_note}"
+        }]
+    if not tokens:
+        return [{
+            "text": f"✅ *All GitLab tokens are valid.* Checked: {summary['tokens_checked']} at {summary['timestamp']}"
+        }]
+
+    title = f"⚠️ *Expiring GitLab tokens detected! ({len(tokens)})*"
+    blocks = [slack_section(title)]
+    if failed:
+        blocks.append(slack_section(failure_note))
+    instance = None
+    groups = {}
+    for t in tokens:
+        groups.setdefault(((t.instance or "") if instances else "", report_source(t)), []).append(t)
+    for (group_instance, source), group in sorted(groups.items()):
+        if instances and group_instance != instance:
+            instance = group_instance
+            blocks.append(slack_section(f"*{instance}* ({instances[instance]['tokens_checked']})"))
+        heading = f"*{source} tokens* ({len(group)})"
+        lines, size = [heading], len(heading)
+        for t in group:
+            scopes = ', '.join(t.scopes)
+            link_info = f"\n  Project: {t.url}" if t.url else f"\n  Source: {t.source}"
+            line = f"• *{t.name}* expires on `{t.expires_at}` ({t.severity or 'warning'}){link_info}\n  Scopes: _{scopes}_"
+            if size + len(line) + 1 > SLACK_SECTION_CHARS:
+                blocks.append(slack_section("\n".join(lines)))
+                lines = [f"*{source} tokens* (continued)"]
+                size = len(lines[0])
+            lines.append(line)
+            size += len(line) + 1
+        blocks.append(slack_section("\n".join(lines)))
+
+    chunks, chunk, size = [], [], 0
+    for block in blocks:
+        block_size = len(block["text"]["text"])
+        if chunk and (len(chunk) == SLACK_MAX_BLOCKS or size + block_size > SLACK_MESSAGE_CHARS):
+            chunks.append(chunk)
+            chunk, size = [], 0
+        chunk.append(block)
+        size += block_size
+    chunks.append(chunk)
+    return [
+        {"text": f"Expiring GitLab tokens detected ({len(tokens)}), part {number}/{len(chunks)}", "blocks": chunk}
+        for number, chunk in enumerate(chunks, 1)
+    ]
+
+
+def post_to_slack(payload):
+    for attempt in range(DELIVERY_RETRIES + 1):
+        resp = None
+        try:
+            resp = requests.post(SLACK_WEBHOOK_URL, json=payload, timeout=5)
+            if resp.status_code not in RETRY_STATUSES or attempt == DELIVERY_RETRIES:
+                resp.raise_for_status()
+                return resp
+        except requests.RequestException:
+            if attempt == DELIVERY_RETRIES:
+                raise
+        time.sleep(retry_delay(resp, attempt))
+
+
 def send_slack_notification(summary, tokens):
     if not SLACK_WEBHOOK_URL:
         logger.warning("SLACK_WEBHOOK_URL is not defined. Skipping Slack send.")
         return
 
-    if not tokens:
-        message = {
-            "text": f"✅ *All GitLab tokens are valid.* Checked: {summary['tokens_checked']} at {summary['timestamp']}"
-        }
-    else:
-        token_lines = []
-        for t in tokens:
-            scopes = ', '.join(t['scopes'])
-            link_info = f"\n  Project: {t['url']}" if t.get("url") else f"\n  Source: {t['source']}"
-            token_lines.append(
-                f"• *{t['name']}* expires on `{t['expires_at']}`{link_info}\n  Scopes: _{scopes}_"
-            )
-        message = {
-            "text": f"⚠️ *Expiring GitLab tokens detected! ({len(tokens)})*\n" + "\n".join(token_lines)
-        }
-
+    messages = slack_messages(summary, tokens)
     try:
-        resp = requests.post(SLACK_WEBHOOK_URL, json=message, timeout=5)
-        resp.raise_for_status()
-        logger.info("Slack notification sent.")
+        # Posted one after another so the parts show up in the channel in order.
+        for message in messages:
+            post_to_slack(message)
+        logger.info(f"Slack notification sent in {len(messages)} messages.")
     except requests.RequestException as e:
         logger.error(f"Failed to send Slack notification: {e}")
 
@@ -95,200 +1055,1212 @@ def send_slack_error_notification(message):
         logger.error(f"Failed to send Slack error notification: {e}")
 
 
-def print_token(token, label=None, link=None):
-    global tokens_printed
-    token_key = (token.get("id"),)
-    if token_key in seen_tokens:
-        return
+def is_expiring(token, expiry):
+    if token.get("revoked") or not token.get("active", True):
+        return False
 
-    seen_tokens[token_key] = True
-    tokens_printed += 1
+    return expiry.severity(token.get("expires_at")) is not None
 
-    expiring_tokens.append({
-        "name": token.get("name"),
-        "scopes": token.get("scopes"),
-        "expires_at": token.get("expires_at"),
-        "created_at": token.get("created_at"),
-        "source": label or "unknown",
-        "url": link or None
-    })
 
-    fields = [
-        ("Token", token.get("name")),
-        ("Scopes", ', '.join(token.get('scopes', [])) or "(not specified)"),
-        ("Created", token.get('created_at', '—')),
-        ("Last used", token.get('last_used_at') or "Never"),
-        ("Expires at", token.get('expires_at')),
-    ]
+def next_page_request(resp, endpoint, params, count):
+    offset = params is not None and "page" in params
+    if offset:
+        next_page = resp.headers.get("X-Next-Page")
+        if next_page is not None:
+            if not next_page:
+                return None, None
+            return endpoint, {**params, "page": int(next_page)}
+
+    link = resp.links.get("next", {}).get("url")
+    if link:
+        return link, None
+
+    # GitLab drops the offset pagination headers above 10k records.
+    if offset and count >= params["per_page"]:
+        return endpoint, {**params, "page": params["page"] + 1}
+
+    return None, None
+
+
+def batched(items, size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+GRAPHQL_MEMBERS = {
+    "projects": ("project", "projectMembers", "path_with_namespace"),
+    "groups": ("group", "groupMembers", "full_path"),
+}
+
+
+def background_iter(iterable, maxsize=PER_PAGE):
+    """Drain iterable on a helper thread so the consumer overlaps with the producer."""
+    buffer = queue.Queue(maxsize=maxsize)
+    stop = threading.Event()
+    done = object()
 
-    max_label_width = max(len(label) for label, _ in fields)
-    for label, value in fields:
-        logger.info(f"{label + ':':<{max_label_width + 1}} {value}")
-    logger.info("-" * 60)
+    def put(item):
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put(item):
+                    return
+        except Exception as e:
+            put((done, e))
+            return
+        put((done, None))
+
+    threading.Thread(target=produce, daemon=True).start()
+    try:
+        while True:
+            item = buffer.get()
+            if isinstance(item, tuple) and len(item) == 2 and item[0] is done:
+                if item[1] is not None:
+                    raise item[1]
+                return
+            yield item
+    finally:
+        stop.set()
+
+
+def ordered_map(func, items, max_workers=None):
+    """Run func over items on a bounded thread pool, yielding results in input order."""
+    max_workers = max_workers or MAX_WORKERS
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = deque()
+        for item in items:
+            pending.append(executor.submit(func, item))
+            if len(pending) >= max_workers * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
 
 
-def get_days_until_expiration(expires_at):
-    if not expires_at or expires_at == "∞":
+def incremental_since(checkpoint, now):
+    if not INCREMENTAL_SCAN or not checkpoint:
         return None
-    expiry_date = datetime.datetime.strptime(expires_at, "%Y-%m-%d").replace(tzinfo=timezone.utc)
-    now = datetime.datetime.now(timezone.utc)
-    return (expiry_date - now).days
+    last_full_scan = datetime.datetime.fromisoformat(checkpoint["last_full_scan"])
+    if now - last_full_scan >= datetime.timedelta(hours=FULL_SCAN_INTERVAL_HOURS):
+        logger.info("Full scan interval reached, rescanning the whole instance")
+        return None
+    return checkpoint["last_scan"]
+
+
+class Deadline:
+    """Tracks the Lambda time budget; without a context it never expires."""
+
+    def __init__(self, context=None, margin_ms=DEADLINE_MARGIN_MS):
+        self.context = context
+        self.margin_ms = margin_ms
+
+    def expired(self):
+        if self.context is None:
+            return False
+        return self.context.get_remaining_time_in_millis() <= self.margin_ms
+
 
+def report_api_failure(instance=None, **extra):
+    error_msg = "GitLab API is unavailable!!! Unable to check tokens."
+    if instance:
+        error_msg = f"GitLab API of {instance} is unavailable!!! Unable to check tokens."
+    logger.error(f"❌ {error_msg}")
+    send_slack_error_notification(error_msg)
+    return {
+        "status": "error",
+        "message": error_msg,
+        "tokens_checked": 0,
+        **extra
+    }
+
+
+class ReportDelivery:
+    """Sends one report in the background: SQS batches in parallel, Slack messages in order on one worker.
+
+    Started as soon as the token list is final, so delivery overlaps whatever the run still
+    has to do; wait() blocks until everything is sent and re-raises the first failure.
+    """
+
+    def __init__(self, tokens, queue_url=None, **extra):
+        severities = {}
+        for token in tokens:
+            severities[token.severity] = severities.get(token.severity, 0) + 1
+        self.summary = {
+            "tokens_checked": len(tokens),
+            "severities": severities,
+            "timestamp": datetime.datetime.utcnow().isoformat(),
+            **extra
+        }
 
-def paginated_get(endpoint):
-    global api_failed
-    results = []
-    for page in range(1, 1000):
-        url = f"{GITLAB_API_URL}/{endpoint}?per_page=100&page={page}"
+        if not tokens:
+            logger.info("All tokens are valid. No tokens are expiring within 30 days.")
+        else:
+            logger.info(f"{len(tokens)} expiring tokens found.")
+
+        self.pool = ThreadPoolExecutor(max_workers=DELIVERY_WORKERS)
+        self.futures = [self.pool.submit(send_slack_notification, self.summary, tokens)]
+        if queue_url:
+            self.futures += [
+                self.pool.submit(send_message_batch, queue_url, batch)
+                for batch in sqs_batches(report_messages(self.summary, tokens))
+            ]
+
+    def wait(self):
         try:
-            resp = requests.get(url, headers=HEADERS, timeout=5)
-            if resp.status_code != 200:
-                break
-            api_failed = False
-            data = resp.json()
-            if not data:
-                break
-            results.extend(data)
-        except requests.RequestException as e:
-            logger.error(f"Request failed: {e}")
-            break
-    return results
+            for future in self.futures:
+                future.result()
+        finally:
+            self.pool.shutdown()
+        return self.summary
+
+
+def deliver_report(tokens, queue_url=None, **extra):
+    return ReportDelivery(tokens, queue_url, **extra).wait()
+
+
+def resolve_token(instance):
+    """Look up an instance's admin token in Secrets Manager or the environment; the config only names it."""
+    if instance.get("token_secret"):
+        secret = aws_client("secretsmanager").get_secret_value(SecretId=instance["token_secret"])["SecretString"]
+        # A JSON secret holds several values; token_key picks the token out of it.
+        return json.loads(secret)[instance["token_key"]] if instance.get("token_key") else secret
+    variable = instance.get("token_env", "GITLAB_ADMIN_TOKEN")
+    token = os.environ.get(variable)
+    if not token:
+        raise EnvironmentError(f"Missing {variable} environment variable for GitLab instance {instance['name']}")
+    return token
+
+
+def load_instances(instances=None):
+    """Normalise GITLAB_INSTANCES entries; each gets a unique name (defaults to the host)."""
+    configs = []
+    for instance in GITLAB_INSTANCES if instances is None else instances:
+        url = instance["url"].rstrip("/")
+        configs.append({**instance, "url": url, "name": instance.get("name") or urlsplit(url).hostname})
+    names = [config["name"] for config in configs]
+    if len(set(names)) != len(names):
+        raise ValueError(f"GitLab instance names must be unique: {names}")
+    return configs
+
+
+class TokenScanner:
+    """Settings, HTTP client and per-run state of one scan.
+
+    Nothing is kept at module level, so every invocation starts from a clean scanner and
+    several scanners (e.g. one per GitLab instance) can run side by side in one process.
+    """
+
+    def __init__(self, base_url=None, headers=None, max_workers=None, rate=None, client=None,
+                 checkpoint_store=None, denylist_file=None, queue_url=None, shard_queue_url=None, name=None,
+                 response_cache=None, listing_cache=None, root_groups=None):
+        self.name = name
+        self.base_url = base_url or GITLAB_BASE_URL
+        self.api_url = f"{self.base_url}/api/v4"
+        self.max_workers = max_workers or MAX_WORKERS
+        rate = RATE_LIMIT_RPS if rate is None else rate
+        client = client or gitlab_client(self.api_url, headers or default_headers(), self.max_workers, rate)
+        # Scanners of the same instance and token share the pooled client but never each other's metrics.
+        self.client = client.with_metrics(Metrics())
+        self.response_cache = RESPONSE_CACHE if response_cache is None else response_cache
+        cache_store = open_store(self.response_cache)
+        self.cache = ResponseCache(cache_store, self.client.session.headers) if cache_store else None
+        self.listings = listing_cache or (warm_listings if LISTING_CACHE_TTL > 0 else None)
+        self.checkpoint_store = CHECKPOINT_STORE if checkpoint_store is None else checkpoint_store
+        self.denylist_file = DENYLIST_FILE if denylist_file is None else denylist_file
+        self.queue_url = SQS_QUEUE_URL if queue_url is None else queue_url
+        self.shard_queue_url = SHARD_QUEUE_URL if shard_queue_url is None else shard_queue_url
+        self.root_groups = list(ROOT_GROUPS if root_groups is None else root_groups)
+        self.phases = TREE_PHASES if self.root_groups else SCAN_PHASES
+        self.denylist = {}
+        self.reset()
+
+    @classmethod
+    def for_instance(cls, instance):
+        """Scanner for one GITLAB_INSTANCES entry; state and deny-list files are kept apart per instance."""
+        name = instance["name"]
+        checkpoint_store = instance.get("checkpoint_store")
+        if checkpoint_store is None and CHECKPOINT_STORE:
+            checkpoint_store = f"{CHECKPOINT_STORE.rstrip('/')}/{name}"
+        response_cache = instance.get("response_cache")
+        if response_cache is None and RESPONSE_CACHE:
+            response_cache = f"{RESPONSE_CACHE.rstrip('/')}/{name}"
+        denylist_file = instance.get("denylist_file")
+        if denylist_file is None and DENYLIST_FILE:
+            root, ext = os.path.splitext(DENYLIST_FILE)
+            denylist_file = f"{root}-{name}{ext}"
+        return cls(
+            base_url=instance["url"],
+            headers={"PRIVATE-TOKEN": resolve_token(instance)},
+            max_workers=instance.get("max_workers"),
+            rate=instance.get("rate_limit_rps"),
+            checkpoint_store=checkpoint_store or "",
+            denylist_file=denylist_file or "",
+            name=name,
+            response_cache=response_cache or "",
+            root_groups=instance.get("root_groups", []),
+        )
+
+    def reset(self, now=None):
+        self.expiry = ExpiryEvaluator(now=now)
+        self.seen_tokens = set()
+        self.expiring_tokens = []
+        self.scanned_entities = {}
+        self.entities_skipped = 0
+        self.listing_failures = 0
+        self.subtrees = {}
+        self.api_failed = True
+
+    @property
+    def tokens_printed(self):
+        return len(self.expiring_tokens)
+
+    def map(self, func, items):
+        return ordered_map(func, items, max_workers=self.max_workers)
+
+    # --- tokens ---------------------------------------------------------
+
+    def is_expiring(self, token):
+        return is_expiring(token, self.expiry)
+
+    def print_token(self, token, label=None, link=None):
+        token_id = token.get("id")
+        if token_id in self.seen_tokens:
+            return
+
+        self.seen_tokens.add(token_id)
+        self.expiring_tokens.append(
+            TokenRecord.from_token(
+                token, self.expiry.severity(token.get("expires_at")), label or "unknown", link or None, self.name
+            )
+        )
 
+        fields = [
+            ("Token", token.get("name")),
+            ("Scopes", ', '.join(token.get('scopes', [])) or "(not specified)"),
+            ("Created", token.get('created_at', '—')),
+            ("Last used", token.get('last_used_at') or "Never"),
+            ("Expires at", token.get('expires_at')),
+        ]
 
-def check_personal_tokens():
-    global api_failed
-    for page in range(1, 1000):
-        url = f"{GITLAB_API_URL}/personal_access_tokens?per_page=100&page={page}"
+        max_label_width = max(len(label) for label, _ in fields)
+        for label, value in fields:
+            logger.info(f"{label + ':':<{max_label_width + 1}} {value}")
+        logger.info("-" * 60)
+
+    # --- listing --------------------------------------------------------
+
+    def fetch_page(self, endpoint, params):
         try:
-            resp = requests.get(url, headers=HEADERS, timeout=5)
+            resp = self.client.get(endpoint, params=params)
         except requests.RequestException as e:
             logger.error(f"Request failed: {e}")
-            break
+            return None
 
         if resp.status_code != 200:
-            break
+            logger.error(f"Fetching {endpoint} page {params.get('page')} failed: HTTP {resp.status_code}")
+            return None
 
-        api_failed = False
-        tokens = resp.json()
-        if not tokens:
-            break
+        try:
+            return decode_json(resp, endpoint)
+        except ValueError as e:
+            logger.error(f"Fetching {endpoint} page {params.get('page')} failed: {e}")
+            return None
 
-        for token in tokens:
-            if token.get("revoked") or not token.get("active", True):
+    def prefetch_pages(self, endpoint, params, total_pages):
+        remaining = ({**params, "page": page} for page in range(params["page"] + 1, total_pages + 1))
+        for data in self.map(partial(self.fetch_page, endpoint), remaining):
+            # Counted here rather than on the pool threads; the remaining pages are still read.
+            if data is None:
+                self.listing_failures += 1
                 continue
+            if data:
+                yield data
+
+    def iter_pages(self, endpoint, params=None, prefetch=None):
+        if prefetch is None:
+            prefetch = endpoint in PREFETCH_ENDPOINTS
+        base_params = {"per_page": PER_PAGE, **(params or {})}
+        keyset = endpoint in KEYSET_ENDPOINTS
+        if keyset:
+            request = (endpoint, {**base_params, "pagination": "keyset", "order_by": "id", "sort": "asc"})
+        else:
+            request = (endpoint, {**base_params, "page": 1})
+
+        first = True
+        while request[0]:
+            url, query = request
+            try:
+                resp = self.client.get(url, params=query)
+            except requests.RequestException as e:
+                logger.error(f"Request failed: {e}")
+                self.listing_failures += 1
+                return
+
+            if keyset and first and resp.status_code in (400, 405):
+                logger.warning(f"Keyset pagination rejected for {endpoint}, falling back to offset pagination")
+                keyset = False
+                request = (endpoint, {**base_params, "page": 1})
+                continue
+            first = False
+
+            if resp.status_code != 200:
+                self.listing_failures += 1
+                return
+
+            try:
+                data = decode_json(resp, endpoint)
+            except ValueError as e:
+                logger.error(f"Listing {endpoint} failed: {e}")
+                self.listing_failures += 1
+                return
+            self.api_failed = False
+            if not data:
+                return
+            yield data
+
+            total_pages = resp.headers.get("X-Total-Pages")
+            if prefetch and not keyset and total_pages and query and query.get("page") == 1:
+                yield from self.prefetch_pages(endpoint, query, int(total_pages))
+                return
+
+            request = next_page_request(resp, endpoint, query, len(data))
+
+    def paginated_get(self, endpoint, params=None, prefetch=None, fields=None, skip=None):
+        for page in self.iter_pages(endpoint, params, prefetch=prefetch):
+            if skip:
+                kept = [entity for entity in page if not skip(entity)]
+                self.entities_skipped += len(page) - len(kept)
+                page = kept
+            if fields:
+                page = [{field: entity.get(field) for field in fields} for entity in page]
+            yield from page
 
-            days_left = get_days_until_expiration(token.get("expires_at"))
-            if days_left is None or days_left > EXPIRY_THRESHOLD_DAYS:
+    def screen_bot_members(self, kind, entities):
+        """Return the entities that have (or may have) a bot member, i.e. an access token."""
+        field, members, path_field = GRAPHQL_MEMBERS[kind]
+        aliases = [
+            f"e{i}: {field}(fullPath: $p{i}) {{ {members}(relations: [DIRECT], first: 100) "
+            f"{{ nodes {{ user {{ bot }} }} pageInfo {{ hasNextPage }} }} }}"
+            for i in range(len(entities))
+        ]
+        declarations = ", ".join(f"$p{i}: ID!" for i in range(len(entities)))
+        query = f"query({declarations}) {{ {' '.join(aliases)} }}"
+        variables = {f"p{i}": entity[path_field] for i, entity in enumerate(entities)}
+        try:
+            resp = self.client.graphql(query, variables)
+            body = decode_json(resp) if resp.status_code == 200 else {}
+        except (requests.RequestException, ValueError) as e:
+            logger.error(f"GraphQL request failed: {e}")
+            body = {}
+        data, errors = body.get("data"), body.get("errors") or []
+        for error in errors:
+            logger.warning(f"GraphQL error at {error.get('path')}: {error.get('message')}")
+        if not data:
+            logger.warning(f"GraphQL screening unavailable, checking {len(entities)} {kind} over REST")
+            return entities
+
+        # A field error nulls its alias; such entities are kept and checked over REST.
+        failed = {error["path"][0] for error in errors if error.get("path")}
+        candidates = []
+        for i, entity in enumerate(entities):
+            node = data.get(f"e{i}")
+            if node is None or f"e{i}" in failed:
+                candidates.append(entity)
                 continue
+            connection = node.get(members) or {}
+            bots = any((member.get("user") or {}).get("bot") for member in connection.get("nodes") or [])
+            if bots or (connection.get("pageInfo") or {}).get("hasNextPage"):
+                candidates.append(entity)
+        return candidates
+
+    def graphql_candidates(self, kind, entities):
+        for batch, candidates in self.map(
+            lambda batch: (batch, self.screen_bot_members(kind, batch)), batched(entities, GRAPHQL_BATCH_SIZE)
+        ):
+            self.entities_skipped += len(batch) - len(candidates)
+            yield from candidates
+
+    # --- deny-list ------------------------------------------------------
+
+    def load_denylist(self, path=None, store=None):
+        if store is not None:
+            entries = store.get(DENYLIST_KEY) or {}
+        else:
+            path = path or self.denylist_file
+            if not path or not os.path.exists(path):
+                return
+            with open(path) as f:
+                entries = json.load(f)
+        oldest = (datetime.datetime.now(timezone.utc) - datetime.timedelta(days=DENYLIST_TTL_DAYS)).date().isoformat()
+        self.denylist.update({key: seen for key, seen in entries.items() if seen >= oldest})
+
+    def save_denylist(self, path=None, store=None):
+        if store is not None:
+            store.put(DENYLIST_KEY, self.denylist)
+            return
+        path = path or self.denylist_file
+        if not path:
+            return
+        with open(path, "w") as f:
+            json.dump(self.denylist, f)
+
+    def in_user_namespace(self, project):
+        namespace = project.get("namespace") or {}
+        return SKIP_USER_NAMESPACES and namespace.get("kind") == "user"
+
+    def skip_project(self, project):
+        if self.in_user_namespace(project):
+            return True
+        return f"projects/{project['id']}" in self.denylist
 
-            user = token.get("user")
-            if user:
-                label = f"{user['username']} <{user.get('email', 'no email')}>"
-                print_token(token, label=label)
+    def skip_group(self, group):
+        return f"groups/{group['id']}" in self.denylist
 
+    # --- token checks ---------------------------------------------------
 
-def check_project_tokens():
-    global api_failed
-    for project in paginated_get("projects"):
-        url = f"{GITLAB_API_URL}/projects/{project['id']}/access_tokens"
+    def fetch_access_tokens(self, kind, entity):
+        endpoint = f"{kind}/{entity['id']}/access_tokens"
+        cached = self.cache.lookup(endpoint) if self.cache else None
         try:
-            resp = requests.get(url, headers=HEADERS, timeout=5)
+            resp = self.client.get(endpoint, headers=self.cache.conditional_headers(cached) if cached else None)
         except requests.RequestException as e:
             logger.error(f"Request failed: {e}")
-            continue
+            return entity, None
 
+        if resp.status_code == 304 and cached:
+            return entity, self.cache.hit(cached)
+        if resp.status_code in (403, 404):
+            self.denylist[f"{kind}/{entity['id']}"] = datetime.datetime.now(timezone.utc).date().isoformat()
         if resp.status_code != 200:
-            continue
+            return entity, None
 
-        api_failed = False
-        for token in resp.json():
-            if token.get("revoked") or not token.get("active", True):
-                continue
+        try:
+            tokens = decode_json(resp)
+        except ValueError as e:
+            logger.error(f"Reading {endpoint} failed: {e}")
+            return entity, None
+        if self.cache:
+            compact = [{field: token.get(field) for field in CACHED_TOKEN_FIELDS} for token in tokens]
+            self.cache.remember(endpoint, resp, compact)
+        return entity, tokens
+
+    def personal_token_filters(self):
+        # expires_before is exclusive; the client-side check below stays authoritative.
+        expires_before = datetime.date.fromisoformat(self.expiry.cutoff) + datetime.timedelta(days=1)
+        return {"state": "active", "revoked": "false", "expires_before": expires_before.isoformat()}
+
+    def check_personal_tokens(self):
+        filtered_locally = 0
+        for tokens in self.iter_pages("personal_access_tokens", self.personal_token_filters()):
+            for token in tokens:
+                if not self.is_expiring(token):
+                    filtered_locally += 1
+                    continue
+
+                user = token.get("user")
+                if user:
+                    label = f"{user['username']} <{user.get('email', 'no email')}>"
+                    self.print_token(token, label=label)
+
+        if filtered_locally:
+            logger.debug(f"Server ignored personal token filters, {filtered_locally} tokens filtered client-side")
+
+    def remember_entity_tokens(self, key, label, link, tokens):
+        kept = [
+            {field: token.get(field) for field in TOKEN_SUMMARY_FIELDS}
+            for token in tokens
+            if token.get("expires_at") and not token.get("revoked") and token.get("active", True)
+        ]
+        self.scanned_entities[key] = {
+            "label": label,
+            "link": link,
+            "earliest_expiry": min((token["expires_at"] for token in kept), default=None),
+            "tokens": kept,
+        }
+
+    def check_entity_tokens(self, key, label, link, tokens):
+        self.remember_entity_tokens(key, label, link, tokens)
+        for token in tokens:
+            if self.is_expiring(token):
+                self.print_token(token, label=label, link=link)
+
+    def entity_link(self, kind, entity):
+        if kind == "projects":
+            return f"{self.base_url}/{entity['path_with_namespace']}"
+        return f"{self.base_url}/groups/{entity['full_path']}"
+
+    def list_projects(self, updated_after=None, after_id=None):
+        params = {**PROJECT_LIST_PARAMS, "order_by": "id", "sort": "asc"}
+        if updated_after:
+            params["last_activity_after"] = updated_after
+        elif self.listings is not None:
+            return self.cached_listing("projects", params, after_id)
+        if after_id:
+            params["id_after"] = after_id
+        return self.paginated_get("projects", params, fields=PROJECT_FIELDS, skip=self.skip_project)
+
+    def list_groups(self, after_id=None):
+        params = {"order_by": "id", "sort": "asc"}
+        if self.listings is not None:
+            groups = self.cached_listing("groups", params)
+        else:
+            groups = self.paginated_get("groups", params, fields=GROUP_FIELDS, skip=self.skip_group)
+        if after_id:
+            groups = (group for group in groups if group["id"] > after_id)
+        return groups
+
+    def cached_listing(self, kind, params, after_id=None):
+        """List entities through the warm-container cache, fetching only ids past the cached ones.
 
-            days_left = get_days_until_expiration(token.get("expires_at"))
-            if days_left is None or days_left > EXPIRY_THRESHOLD_DAYS:
+        /projects takes id_after, so the cached listing is topped up from its last id; /groups
+        does not, so a group listing is reused as is until the TTL runs out.
+        """
+        path_field = LISTING_PATH_FIELDS[kind]
+        skip = self.skip_project if kind == "projects" else self.skip_group
+        key = (self.api_url, token_fingerprint(self.client.session.headers), kind, json.dumps(params, sort_keys=True))
+        cached = self.listings.get(key)
+        listed_at, entries = cached or (time.monotonic(), ())
+        if not cached and after_id:
+            # A listing starting mid-way cannot seed the cache; resume without it.
+            yield from self.paginated_get(kind, {**params, "id_after": after_id}, fields=("id", path_field), skip=skip)
+            return
+
+        for entity_id, path in entries:
+            if after_id and entity_id <= after_id:
+                continue
+            entity = {"id": entity_id, path_field: path}
+            if skip(entity):
+                self.entities_skipped += 1
                 continue
+            yield entity
+        if cached and kind not in KEYSET_ENDPOINTS:
+            return
 
-            path = project['path_with_namespace']
-            label = "Project"
-            link = f"{GITLAB_BASE_URL}/{path}"
-            print_token(token, label=label, link=link)
+        query = {**params, "id_after": entries[-1][0]} if entries else params
+        fetched, failures, complete = [], self.listing_failures, False
+        try:
+            for entity in self.paginated_get(kind, query, skip=self.in_user_namespace if kind == "projects" else None):
+                fetched.append((entity["id"], entity[path_field]))
+                entity = {"id": entity["id"], path_field: entity[path_field]}
+                if after_id and entity["id"] <= after_id:
+                    continue
+                if skip(entity):
+                    self.entities_skipped += 1
+                    continue
+                yield entity
+            complete = self.listing_failures == failures
+        finally:
+            # Listings run in id order, so a /projects listing cut short is still a prefix to continue from.
+            if complete or kind in KEYSET_ENDPOINTS:
+                self.listings.put(key, listed_at, entries + tuple(fetched))
+
+    def scan_entities(self, kind, entities, deadline=None):
+        """Check the access tokens of each entity; returns the last finished id if the deadline cut it short."""
+        fetch = partial(self.fetch_access_tokens, kind)
+        if FETCH_BACKEND == "graphql":
+            entities = self.graphql_candidates(kind, entities)
+        for entity, tokens in self.map(fetch, background_iter(entities)):
+            if tokens is not None:
+                self.api_failed = False
+                self.check_entity_tokens(
+                    f"{kind}/{entity['id']}", ENTITY_LABELS[kind], self.entity_link(kind, entity), tokens
+                )
 
+            if deadline and deadline.expired():
+                return entity["id"]
+        return None
 
-def check_group_tokens():
-    global api_failed
-    for group in paginated_get("groups"):
-        url = f"{GITLAB_API_URL}/groups/{group['id']}/access_tokens"
+    def check_project_tokens(self, updated_after=None, after_id=None, deadline=None):
+        return self.scan_entities("projects", self.list_projects(updated_after, after_id), deadline)
+
+    def check_group_tokens(self, after_id=None, deadline=None):
+        return self.scan_entities("groups", self.list_groups(after_id), deadline)
+
+    # --- namespace tree -------------------------------------------------
+
+    def root_group(self, group):
         try:
-            resp = requests.get(url, headers=HEADERS, timeout=5)
+            resp = self.client.get(f"groups/{quote(str(group), safe='')}")
         except requests.RequestException as e:
             logger.error(f"Request failed: {e}")
-            continue
-
+            return None
         if resp.status_code != 200:
-            continue
+            logger.error(f"Root group {group} not found: HTTP {resp.status_code}")
+            return None
+        try:
+            data = decode_json(resp)
+        except ValueError as e:
+            logger.error(f"Root group {group} could not be read: {e}")
+            return None
+        return {field: data.get(field) for field in GROUP_FIELDS}
 
-        api_failed = False
-        for token in resp.json():
-            if token.get("revoked") or not token.get("active", True):
+    def walk_subtree(self, root):
+        """Yield (kind, entity) for a root group, every group below it and every project in any of them."""
+        if not self.skip_group(root):
+            yield "groups", root
+        params = {"order_by": "id", "sort": "asc"}
+        descendants = self.paginated_get(
+            f"groups/{root['id']}/descendant_groups", params, prefetch=True, fields=GROUP_FIELDS, skip=self.skip_group
+        )
+        for group in descendants:
+            yield "groups", group
+        projects = self.paginated_get(
+            f"groups/{root['id']}/projects", {**PROJECT_LIST_PARAMS, **params, "include_subgroups": "true"},
+            prefetch=True, fields=PROJECT_FIELDS, skip=self.skip_project,
+        )
+        for project in projects:
+            yield "projects", project
+
+    def fetch_node_tokens(self, node):
+        kind, entity = node
+        return node, self.fetch_access_tokens(kind, entity)[1]
+
+    def scan_subtree(self, root, deadline=None):
+        """Check group and project tokens of one subtree in a single pass; False if the deadline cut it short."""
+        started = time.perf_counter()
+        counts = {"groups": 0, "projects": 0}
+        # Overlapping roots, and a subtree resumed after a deadline, skip the nodes already checked.
+        nodes = (
+            (kind, entity) for kind, entity in self.walk_subtree(root)
+            if f"{kind}/{entity['id']}" not in self.scanned_entities
+        )
+        finished = True
+        for (kind, entity), tokens in self.map(self.fetch_node_tokens, background_iter(nodes)):
+            counts[kind] += 1
+            if tokens is not None:
+                self.api_failed = False
+                self.check_entity_tokens(
+                    f"{kind}/{entity['id']}", ENTITY_LABELS[kind], self.entity_link(kind, entity), tokens
+                )
+
+            if deadline and deadline.expired():
+                finished = False
+                break
+        self.subtrees[root["full_path"]] = {"seconds": round(time.perf_counter() - started, 3), **counts}
+        logger.info(
+            f"Group tree {root['full_path']}: {counts['groups']} groups and {counts['projects']} projects "
+            f"in {self.subtrees[root['full_path']]['seconds']}s"
+        )
+        return finished
+
+    def check_group_tree(self, start=None, deadline=None):
+        """Scan the root groups in turn; returns the index of the root to resume from if the deadline cut it short."""
+        start = start or 0
+        for index, group in enumerate(self.root_groups[start:], start):
+            root = self.root_group(group)
+            if root is None:
+                self.listing_failures += 1
                 continue
+            if not self.scan_subtree(root, deadline):
+                return index
+        return None
+
+    # --- incremental and resumable runs ---------------------------------
 
-            days_left = get_days_until_expiration(token.get("expires_at"))
-            if days_left is None or days_left > EXPIRY_THRESHOLD_DAYS:
+    def replay_checkpoint(self, checkpoint, prefix):
+        """Re-evaluate cached tokens of entities the incremental listing did not return."""
+        for key, entity in checkpoint["entities"].items():
+            if not key.startswith(prefix) or key in self.scanned_entities:
                 continue
+            self.scanned_entities[key] = entity
+            if not entity["earliest_expiry"] or entity["earliest_expiry"] > self.expiry.cutoff:
+                continue
+            for token in entity["tokens"]:
+                if self.is_expiring(token):
+                    self.print_token(token, label=entity["label"], link=entity["link"])
+
+    def save_checkpoint(self, store, started_at, previous=None):
+        if store is None:
+            return
+        store.put(CHECKPOINT_KEY, {
+            "last_scan": started_at.isoformat(),
+            "last_full_scan": previous["last_full_scan"] if previous else started_at.isoformat(),
+            "entities": self.scanned_entities,
+        })
+
+    def snapshot_run(self, run):
+        return {
+            **run,
+            "api_failed": self.api_failed,
+            "seen_tokens": list(self.seen_tokens),
+            "expiring_tokens": [token.to_dict() for token in self.expiring_tokens],
+            "scanned_entities": self.scanned_entities,
+            # The next slice may run in another container, so what this one learned travels with the run.
+            "denylist": self.denylist,
+            "entities_skipped": self.entities_skipped,
+            "metrics": self.client.metrics.export(),
+        }
 
-            label = "Group"
-            link = f"{GITLAB_BASE_URL}/groups/{group['full_path']}"
-            print_token(token, label=label, link=link)
+    def restore_run(self, run):
+        self.api_failed = run["api_failed"]
+        self.seen_tokens = set(run["seen_tokens"])
+        self.expiring_tokens = [TokenRecord.from_dict(token) for token in run["expiring_tokens"]]
+        self.scanned_entities = dict(run["scanned_entities"])
+        self.denylist.update(run.get("denylist", {}))
+        self.entities_skipped = run.get("entities_skipped", 0)
+        if run.get("metrics"):
+            self.client.metrics.merge(run["metrics"])
 
+    def suspend_run(self, store, run):
+        store.put(f"{RUN_STATE_PREFIX}{run['run_id']}.json", self.snapshot_run(run))
+        send_message(
+            self.queue_url,
+            json.dumps({"type": "resume", "run_id": run["run_id"], "instance": self.name}),
+            {"type": {"DataType": "String", "StringValue": "resume"}},
+        )
+        logger.info(f"Deadline approaching, run {run['run_id']} suspended in {run['phase']} after id {run['cursor']}")
 
-def lambda_handler(event=None, context=None):
-    global tokens_printed, api_failed
-    try:
-        logger.info("=== Lambda execution started ===")
-        logger.info(f"Token length: {len(GITLAB_ADMIN_TOKEN) if GITLAB_ADMIN_TOKEN else 'MISSING'}")
+    def run_phase(self, phase, run, checkpoint, deadline):
+        if phase == "personal_tokens":
+            self.check_personal_tokens()
+            return None
+        if phase == "project_tokens":
+            cursor = self.check_project_tokens(updated_after=run["since"], after_id=run["cursor"], deadline=deadline)
+            if cursor is None and run["since"]:
+                self.replay_checkpoint(checkpoint, "projects/")
+            return cursor
+        if phase == "group_tree":
+            return self.check_group_tree(start=run["cursor"], deadline=deadline)
+        return self.check_group_tokens(after_id=run["cursor"], deadline=deadline)
+
+    def scan_phases(self, run, checkpoint, deadline):
+        """Run the remaining phases of a scan; returns False when it stopped early for the deadline."""
+        for phase in self.phases[self.phases.index(run["phase"]):]:
+            if phase != run["phase"]:
+                run["phase"], run["cursor"] = phase, None
+            if deadline.expired():
+                return False
+
+            if phase in PHASE_BANNERS:
+                logger.info(PHASE_BANNERS[phase])
+            with self.client.metrics.phase(phase):
+                run["cursor"] = self.run_phase(phase, run, checkpoint, deadline)
+            if run["cursor"] is not None:
+                return False
+        return True
+
+    # --- reporting ------------------------------------------------------
+
+    def start_report(self):
+        return ReportDelivery(self.expiring_tokens, self.queue_url)
+
+    def send_report(self):
+        return self.start_report().wait()
+
+    def run_metrics(self):
+        extra = {"response_cache": self.cache.stats()} if self.cache else {}
+        if self.subtrees:
+            extra["subtrees"] = dict(self.subtrees)
+        return self.client.metrics.summary(entities_skipped=self.entities_skipped, **extra)
+
+    def run_scan(self, context=None, run_id=None, notify=True):
+        """Scan the instance; with notify=False the caller reports expiring_tokens itself."""
+        self.client.metrics.reset()
+        connections_at_start = self.client.connection_stats()
+        store = open_store(self.checkpoint_store)
+        checkpoint = store.get(CHECKPOINT_KEY) if store else None
 
-        check_personal_tokens()
-        logger.info("\n--- Project Tokens ---\n")
-        check_project_tokens()
-        logger.info("\n--- Group Tokens ---\n")
-        check_group_tokens()
+        if run_id:
+            run = store.get(f"{RUN_STATE_PREFIX}{run_id}.json") if store else None
+            if run is None:
+                logger.warning(f"No saved state for run {run_id}, nothing to resume")
+                return {"status": "ignored"}
+            started_at = datetime.datetime.fromisoformat(run["started_at"])
+            self.reset(now=started_at)
+            self.restore_run(run)
+            logger.info(f"Resuming run {run_id} in {run['phase']} after id {run['cursor']}")
+        else:
+            started_at = datetime.datetime.now(timezone.utc)
+            self.reset(now=started_at)
+            run = {
+                "run_id": uuid.uuid4().hex,
+                "started_at": started_at.isoformat(),
+                # A scan scoped to root groups is always full and never replaces the instance checkpoint.
+                "since": None if self.root_groups else incremental_since(checkpoint, started_at),
+                "phase": self.phases[0],
+                "cursor": None,
+            }
+            if run["since"]:
+                logger.info(f"Incremental scan of projects active after {run['since']}")
+        self.load_denylist()
+        if self.cache:
+            self.cache.load()
 
-        if api_failed:
-            error_msg = "GitLab API is unavailable!!! Unable to check tokens."
-            logger.error(f"❌ {error_msg}")
-            send_slack_error_notification(error_msg)
+        if store is None or not self.queue_url:
+            context = None
+        deadline = Deadline(context)
+
+        if not self.scan_phases(run, checkpoint, deadline):
+            if self.cache:
+                self.cache.save()
+            self.suspend_run(store, run)
             return {
-                "status": "error",
-                "message": error_msg,
-                "tokens_checked": 0
+                "status": "suspended",
+                "run_id": run["run_id"],
+                "phase": run["phase"],
+                "metrics": self.run_metrics()
             }
 
-        summary = {
-            "tokens_checked": tokens_printed,
-            "timestamp": datetime.datetime.utcnow().isoformat()
+        # The token list is final here; the report goes out while the run state is written.
+        delivery = self.start_report() if notify and not self.api_failed else None
+        if run_id:
+            store.delete(f"{RUN_STATE_PREFIX}{run_id}.json")
+        self.save_denylist()
+        if not self.api_failed and not self.root_groups:
+            self.save_checkpoint(store, started_at, checkpoint if run["since"] else None)
+        logger.info(f"Pre-filter skipped {self.entities_skipped} access token calls")
+
+        if self.cache:
+            self.cache.save()
+        run_metrics = self.run_metrics()
+        logger.info(f"Scan metrics: {json.dumps(run_metrics)}")
+        if METRICS_EMF:
+            emit_emf(run_metrics)
+
+        if self.api_failed:
+            return report_api_failure(self.name, metrics=run_metrics)
+
+        if delivery:
+            delivery.wait()
+
+        connections = self.client.connection_stats(since=connections_at_start)
+        logger.info(
+            f"GitLab connections: {connections['connections_opened']} opened, "
+            f"{connections['connections_reused']} reused for {connections['requests']} requests"
+        )
+        logger.info("=== Lambda execution finished ===")
+        return {
+            "status": "ok",
+            "tokens_checked": self.tokens_printed,
+            "calls_skipped": self.entities_skipped,
+            "connections": connections,
+            "metrics": run_metrics
         }
 
-        if tokens_printed == 0:
-            logger.info("All tokens are valid. No tokens are expiring within 30 days.")
+    # --- sharded runs ---------------------------------------------------
+
+    def publish(self, message):
+        if self.name:
+            message = {**message, "instance": self.name}
+        send_message(
+            self.shard_queue_url, json.dumps(message), {"type": {"DataType": "String", "StringValue": message["type"]}}
+        )
+
+    def sharding_store(self):
+        store = open_store(self.checkpoint_store)
+        if store is None or not self.shard_queue_url:
+            raise EnvironmentError("Sharded scans need CHECKPOINT_STORE and SHARD_QUEUE_URL (or SQS_QUEUE_URL)")
+        return store
+
+    def coordinate_run(self):
+        """List projects and groups once and publish one SQS message per shard of entities."""
+        store = self.sharding_store()
+        self.reset()
+        self.load_denylist()
+        # Shards run in other containers; what they learn is merged by the reducer into the shared store.
+        self.load_denylist(store=store)
+        run_id = uuid.uuid4().hex
+
+        shards = [{"kind": "personal_tokens"}]
+        for kind, entities in (("projects", self.list_projects()), ("groups", self.list_groups())):
+            for batch in batched(entities, SHARD_SIZE):
+                shards.append({"kind": kind, "id_range": [batch[0]["id"], batch[-1]["id"]], "entities": batch})
+        if self.api_failed:
+            return report_api_failure(self.name)
+
+        store.put(f"{RUN_STATE_PREFIX}{run_id}/manifest.json", {
+            "shards": len(shards),
+            "started_at": datetime.datetime.now(timezone.utc).isoformat(),
+        })
+        for index, shard in enumerate(shards):
+            self.publish({"type": "shard", "run_id": run_id, "shard": index, **shard})
+        logger.info(f"Run {run_id} split into {len(shards)} shards")
+        return {"status": "coordinated", "run_id": run_id, "shards": len(shards)}
+
+    def partial_result(self, kind=None, entities=None):
+        part = {
+            "api_failed": self.api_failed,
+            "tokens": [token.to_dict() for token in self.expiring_tokens],
+            "denied": self.denylist,
+            "entities": self.scanned_entities,
+            "entities_skipped": self.entities_skipped,
+            "metrics": self.client.metrics.export(),
+        }
+        if self.cache and entities:
+            # Whoever merges the parts owns the cache document and writes it back.
+            part["cache"] = self.cache.export(f"{kind}/{entity['id']}/access_tokens" for entity in entities)
+        return part
+
+    def run_shard(self, message):
+        store = self.sharding_store()
+        self.reset()
+        self.load_denylist()
+        run_id, index = message["run_id"], message["shard"]
+        kind = message["kind"]
+        # Shard boundaries move as entities come and go, so every shard reads the one shared cache
+        # document and hands its refreshed entries to the reducer, which writes the document back.
+        if self.cache:
+            self.cache.load()
+        if kind == "personal_tokens":
+            self.check_personal_tokens()
         else:
-            logger.info(f"{tokens_printed} expiring tokens found.")
+            self.scan_entities(kind, message["entities"])
+        self.save_denylist()
 
-        if SQS_QUEUE_URL:
-            message = {
-                "summary": summary,
-                "tokens": expiring_tokens
-            }
-            send_message(SQS_QUEUE_URL, json.dumps(message))
+        part = self.partial_result(kind, message.get("entities"))
+        store.put(f"{RUN_STATE_PREFIX}{run_id}/parts/{index}.json", part)
+        self.publish({"type": "reduce", "run_id": run_id})
+        return {"status": "shard_done", "run_id": run_id, "shard": index, "tokens_checked": self.tokens_printed}
+
+    def merge_part(self, part):
+        """Fold a shard/partition result into the run state, keeping the first occurrence of each token."""
+        if not part["api_failed"]:
+            self.api_failed = False
+        for token in part["tokens"]:
+            if token["id"] in self.seen_tokens:
+                continue
+            self.seen_tokens.add(token["id"])
+            self.expiring_tokens.append(TokenRecord.from_dict(token))
+        self.denylist.update(part.get("denied", {}))
+        self.scanned_entities.update(part.get("entities", {}))
+        self.entities_skipped += part.get("entities_skipped", 0)
+        if part.get("metrics"):
+            self.client.metrics.merge(part["metrics"])
+        if self.cache and part.get("cache"):
+            self.cache.merge(part["cache"])
 
-        send_slack_notification(summary, expiring_tokens)
+    def reduce_run(self, run_id):
+        """Merge shard results once every part is in; only the first complete reducer reports."""
+        store = self.sharding_store()
+        prefix = f"{RUN_STATE_PREFIX}{run_id}"
+        manifest = store.get(f"{prefix}/manifest.json")
+        if manifest is None:
+            return {"status": "ignored", "run_id": run_id}
 
-        logger.info("=== Lambda execution finished ===")
+        parts = []
+        for index in range(manifest["shards"]):
+            part = store.get(f"{prefix}/parts/{index}.json")
+            if part is None:
+                return {"status": "waiting", "run_id": run_id}
+            parts.append(part)
+        if not store.put_if_absent(f"{prefix}/reduced.json", {"reduced_at": datetime.datetime.now(timezone.utc).isoformat()}):
+            return {"status": "already_reduced", "run_id": run_id}
+
+        self.reset()
+        self.load_denylist(store=store)
+        if self.cache:
+            self.cache.load()
+        for part in parts:
+            self.merge_part(part)
+        self.save_denylist(store=store)
+        if self.cache:
+            self.cache.save()
+
+        for index in range(manifest["shards"]):
+            store.delete(f"{prefix}/parts/{index}.json")
+        store.delete(f"{prefix}/manifest.json")
+
+        if self.api_failed:
+            return report_api_failure(self.name, run_id=run_id)
+        self.send_report()
+        return {"status": "ok", "run_id": run_id, "shards": manifest["shards"], "tokens_checked": self.tokens_printed}
+
+    # --- entry points ---------------------------------------------------
+
+    def handle_message(self, body, context=None):
+        message_type = body.get("type")
+        if message_type == "resume":
+            return self.run_scan(context, body.get("run_id"))
+        if message_type == "shard":
+            return self.run_shard(body)
+        if message_type == "reduce":
+            return self.reduce_run(body["run_id"])
+        logger.info("SQS message is not a scan request, ignoring")
+        return {"status": "ignored"}
+
+    def handle(self, event=None, context=None):
+        event = event if isinstance(event, dict) else {}
+        if event.get("Records"):
+            return batch_result([self.handle_message(body, context) for body in message_bodies(event)])
+        if event.get("resume_run_id"):
+            return self.run_scan(context, event["resume_run_id"])
+        # Shards partition the flat instance listings, so a scan scoped to root groups always runs in one pass.
+        if event.get("mode", SCAN_MODE) == "sharded" and not self.root_groups:
+            return self.coordinate_run()
+        return self.run_scan(context)
+
+    def run_parallel_scan(self, processes, partition_size=PARTITION_SIZE):
+        """Scan on a process pool: this scanner lists entities and each child scans contiguous id partitions."""
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+
+        # The budget is split evenly, with one share kept here for listing and personal tokens.
+        rate = self.client.limiter.rate / (processes + 1) if self.client.limiter.rate else 0
+        self.client.limiter = RateLimiter(rate=rate, burst=self.max_workers)
+        settings = {
+            "base_url": self.base_url,
+            "max_workers": self.max_workers,
+            "rate": rate,
+            "response_cache": self.response_cache,
+        }
+        store = open_store(self.checkpoint_store)
+        started_at = datetime.datetime.now(timezone.utc)
+        self.reset(now=started_at)
+        self.client.metrics.reset()
+        self.load_denylist()
+        if self.cache:
+            self.cache.load()
+
+        with ProcessPoolExecutor(
+            max_workers=processes,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=configure_process,
+            initargs=(settings,),
+        ) as pool:
+            with self.client.metrics.phase("listing"):
+                futures = [
+                    pool.submit(scan_partition, kind, partition)
+                    for kind, entities in (("projects", self.list_projects()), ("groups", self.list_groups()))
+                    for partition in batched(entities, partition_size)
+                ]
+            with self.client.metrics.phase("personal_tokens"):
+                self.check_personal_tokens()
+            with self.client.metrics.phase("partitions"):
+                for future in futures:
+                    self.merge_part(future.result())
+
+        self.save_denylist()
+        if self.cache:
+            self.cache.save()
+        if not self.api_failed:
+            self.save_checkpoint(store, started_at)
+        run_metrics = self.run_metrics()
+        logger.info(f"Scan metrics: {json.dumps(run_metrics)}")
+        if METRICS_EMF:
+            emit_emf(run_metrics)
+
+        if self.api_failed:
+            return report_api_failure(self.name, metrics=run_metrics)
+        self.send_report()
         return {
             "status": "ok",
-            "tokens_checked": tokens_printed
+            "tokens_checked": self.tokens_printed,
+            "calls_skipped": self.entities_skipped,
+            "partitions": len(futures),
+            "metrics": run_metrics,
         }
 
+
+def message_bodies(event):
+    for record in event.get("Records") or []:
+        try:
+            body = json.loads(record.get("body") or "")
+        except ValueError:
+            body = None
+        yield body if isinstance(body, dict) else {}
+
+
+def batch_result(results):
+    return results[0] if len(results) == 1 else {"status": "batch", "results": results}
+
+
+def scan_instances(instances, context=None):
+    """Scan every instance concurrently and send one report with the tokens grouped by instance."""
+
+    def run(instance):
+        # One broken instance, including one whose token cannot be resolved, must not take the others' report down.
+        scanner = None
+        try:
+            scanner = TokenScanner.for_instance(instance)
+            return scanner, scanner.run_scan(context, notify=False)
+        except Exception as e:
+            logger.exception(f"Scan of GitLab instance {instance['name']} failed")
+            send_slack_error_notification(f"Scan of {instance['name']} failed:\n{e}")
+            return scanner, {"status": "error", "error": str(e), "tokens_checked": 0}
+
+    with ThreadPoolExecutor(max_workers=len(instances)) as pool:
+        runs = list(pool.map(run, instances))
+
+    summaries = {
+        instance["name"]: {"url": instance["url"], "status": result["status"], "tokens_checked": result["tokens_checked"]}
+        for instance, (scanner, result) in zip(instances, runs)
+        if result["status"] in ("ok", "error")
+    }
+    tokens = [
+        token
+        for scanner, result in runs if result["status"] == "ok"
+        for token in scanner.expiring_tokens
+    ]
+    # Suspended instances report on their own once their resumed run finishes; when every scan failed,
+    # the error notifications are the report.
+    if any(summary["status"] == "ok" for summary in summaries.values()):
+        deliver_report(tokens, SQS_QUEUE_URL, instances=summaries)
+
+    statuses = {result["status"] for scanner, result in runs}
+    return {
+        "status": statuses.pop() if len(statuses) == 1 else "partial",
+        "tokens_checked": len(tokens),
+        "instances": {instance["name"]: result for instance, (scanner, result) in zip(instances, runs)},
+    }
+
+
+def handle_instances(instances, event, context=None):
+    """Route an event in multi-instance mode; queued messages name the instance they belong to."""
+    configs = {instance["name"]: instance for instance in instances}
+    event = event if isinstance(event, dict) else {}
+
+    def scanner_for(name):
+        if name not in configs:
+            logger.warning(f"Unknown GitLab instance {name!r}, ignoring")
+            return None
+        return TokenScanner.for_instance(configs[name])
+
+    if event.get("Records"):
+        results = []
+        for body in message_bodies(event):
+            scanner = scanner_for(body.get("instance"))
+            results.append(scanner.handle_message(body, context) if scanner else {"status": "ignored"})
+        return batch_result(results)
+    if event.get("resume_run_id"):
+        scanner = scanner_for(event.get("instance"))
+        return scanner.run_scan(context, event["resume_run_id"]) if scanner else {"status": "ignored"}
+    if event.get("mode", SCAN_MODE) == "sharded":
+        return batch_result([coordinate_instance(instance) for instance in instances])
+    return scan_instances(instances, context)
+
+
+def coordinate_instance(instance):
+    # As in scan_instances, one instance that cannot be set up must not stop the others' runs.
+    try:
+        return TokenScanner.for_instance(instance).coordinate_run()
+    except Exception as e:
+        logger.exception(f"Coordinating a sharded run of GitLab instance {instance['name']} failed")
+        send_slack_error_notification(f"Sharded scan of {instance['name']} failed:\n{e}")
+        return {"status": "error", "error": str(e)}
+
+
+def lambda_handler(event=None, context=None, scanner=None):
+    try:
+        logger.info("=== Lambda execution started ===")
+        if scanner is None and GITLAB_INSTANCES:
+            return handle_instances(load_instances(), event, context)
+        logger.info(f"Token length: {len(GITLAB_ADMIN_TOKEN) if GITLAB_ADMIN_TOKEN else 'MISSING'}")
+        # A fresh scanner per invocation: warm containers must not carry state between runs.
+        return (scanner or TokenScanner()).handle(event, context)
+
     except Exception as e:
         logger.error("ERROR OCCURRED IN LAMBDA EXECUTION")
         logger.error(str(e))
@@ -302,5 +2274,59 @@ def lambda_handler(event=None, context=None):
         }
 
 
+# One scanner per pool process, created by the pool initializer.
+process_scanner = None
+
+
+def configure_process(settings):
+    global process_scanner
+    process_scanner = TokenScanner(**settings)
+    if process_scanner.cache:
+        process_scanner.cache.load()
+
+
+def scan_partition(kind, entities):
+    process_scanner.reset()
+    process_scanner.client.metrics.reset()
+    process_scanner.scan_entities(kind, entities)
+    return process_scanner.partial_result(kind, entities)
+
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="gitlab-token-checker", description="Report GitLab tokens close to expiry.")
+    commands = parser.add_subparsers(dest="command")
+    scan = commands.add_parser("scan", help="scan the GitLab instance once")
+    scan.add_argument("--workers", type=int, default=1,
+                      help="scanner processes; more than one partitions projects and groups across a process pool")
+    scan.add_argument("--threads", type=int, default=MAX_WORKERS, help="concurrent requests per process")
+    scan.add_argument("--partition-size", type=int, default=PARTITION_SIZE,
+                      help="projects or groups handed to a process at a time")
+    scan.add_argument("--root-group", action="append", dest="root_groups", metavar="GROUP",
+                      help="scan only this group and everything below it (id or full path); repeatable")
+    args = parser.parse_args(argv)
+    if args.command is None:
+        args = parser.parse_args(["scan"])
+    if args.root_groups and args.workers > 1:
+        parser.error("--root-group cannot be combined with --workers")
+
+    if GITLAB_INSTANCES:
+        if args.workers > 1 or args.root_groups:
+            parser.error("with GITLAB_INSTANCES set, use each instance's root_groups; --workers is not supported")
+        instances = [
+            {**instance, "max_workers": instance.get("max_workers") or args.threads} for instance in load_instances()
+        ]
+        result = handle_instances(instances, {})
+        return 0 if result["status"] == "ok" else 1
+
+    scanner = TokenScanner(max_workers=args.threads, root_groups=args.root_groups)
+    if args.workers > 1:
+        result = scanner.run_parallel_scan(args.workers, args.partition_size)
+    else:
+        result = lambda_handler(scanner=scanner)
+    return 0 if result["status"] == "ok" else 1
+
+
 if __name__ == "__main__":
-    lambda_handler()
+    raise SystemExit(main())
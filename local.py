@@ -5,7 +5,7 @@ import os
 import logging
 
 # Настройки
-GITLAB_BASE_URL = "http://192.168.64.6"
+GITLAB_BASE_URL = os.environ.get("GITLAB_BASE_URL", "http://192.168.64.6")
 GITLAB_API_URL = f"{GITLAB_BASE_URL}/api/v4"
 GITLAB_ADMIN_TOKEN = os.environ.get("GITLAB_ADMIN_TOKEN")
 HEADERS = {"PRIVATE-TOKEN": GITLAB_ADMIN_TOKEN}
@@ -0,0 +1,106 @@
+"""Run lambda_handler() end to end against a synthetic FakeGitLab instance and report throughput.
+
+    python tests/benchmark.py --projects 5000 --groups 200 --latency-ms 20 --workers 16
+    python tests/benchmark.py --rate 30
+    python tests/benchmark.py --decoders
+"""
+import argparse
+import json
+import os
+import resource
+import sys
+import time
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("GITLAB_ADMIN_TOKEN", "benchmark-token")
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+
+import gitlab_tokens  # noqa: E402
+from fake_gitlab import FakeGitLab  # noqa: E402
+
+
+def point_at(fake, workers=None, rate=None):
+    """Aim newly created scanners at fake and return one; pacing stays at the module default unless rate is given."""
+    workers = workers or gitlab_tokens.MAX_WORKERS
+    gitlab_tokens.GITLAB_BASE_URL = fake.url
+    gitlab_tokens.GITLAB_API_URL = f"{fake.url}/api/v4"
+    gitlab_tokens.MAX_WORKERS = workers
+    if rate is not None:
+        gitlab_tokens.RATE_LIMIT_RPS = rate
+    return gitlab_tokens.TokenScanner()
+
+
+def run_benchmark(fake, workers=None, rate=None):
+    scanner = point_at(fake, workers, rate)
+    started = time.perf_counter()
+    result = gitlab_tokens.lambda_handler(scanner=scanner)
+    wall_time = time.perf_counter() - started
+    return {
+        "status": result["status"],
+        "rate_limit_rps": scanner.client.limiter.rate,
+        "tokens_found": result.get("tokens_checked"),
+        "tokens_expected": fake.expected_expiring(),
+        "wall_time_s": round(wall_time, 3),
+        "requests": fake.request_count,
+        "requests_per_s": round(fake.request_count / wall_time, 1) if wall_time else None,
+        "throttled": fake.throttled,
+        "endpoints": dict(sorted(fake.endpoint_counts.items())),
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "metrics": result.get("metrics"),
+    }
+
+
+def available_decoders():
+    return ["json"] + [name for name in ("orjson", "msgspec") if getattr(gitlab_tokens, name)]
+
+
+def decoder_benchmark(fake, pages=50, per_page=100, backends=None):
+    """Decode the same /projects pages with each JSON backend; returns seconds and first-page output per backend."""
+    page = json.dumps([fake.project(i) for i in range(1, per_page + 1)]).encode()
+    response = requests.Response()
+    response.status_code, response._content = 200, page
+    report = {}
+    for backend in backends or available_decoders():
+        started = time.perf_counter()
+        for _ in range(pages):
+            data = gitlab_tokens.decode_json(response, "projects", backend=backend)
+        report[backend] = {"seconds": round(time.perf_counter() - started, 4), "page": data}
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--projects", type=int, default=1000)
+    parser.add_argument("--groups", type=int, default=100)
+    parser.add_argument("--tokens", type=int, default=2, help="access tokens per project/group")
+    parser.add_argument("--personal-tokens", type=int, default=500)
+    parser.add_argument("--latency-ms", type=float, default=5.0)
+    parser.add_argument("--throttle-every", type=int, default=0, help="answer every Nth request with 429")
+    parser.add_argument("--max-per-page", type=int, default=100)
+    parser.add_argument("--workers", type=int, default=gitlab_tokens.MAX_WORKERS)
+    parser.add_argument("--rate", type=float, default=None,
+                        help="client-side requests/s (default: GITLAB_RATE_LIMIT_RPS, as in production)")
+    parser.add_argument("--decoders", action="store_true", help="compare the JSON decoders on /projects pages")
+    args = parser.parse_args(argv)
+
+    if args.decoders:
+        report = decoder_benchmark(FakeGitLab())
+        print(json.dumps({backend: result["seconds"] for backend, result in report.items()}, indent=2))
+        return 0
+
+    gitlab_tokens.logger.setLevel("WARNING")
+    fake = FakeGitLab(
+        projects=args.projects, groups=args.groups, tokens=args.tokens,
+        personal_tokens=args.personal_tokens, latency=args.latency_ms / 1000,
+        throttle_every=args.throttle_every, max_per_page=args.max_per_page,
+    )
+    with fake:
+        report = run_benchmark(fake, args.workers, args.rate)
+    print(json.dumps(report, indent=2))
+    return 0 if report["tokens_found"] == report["tokens_expected"] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,16 @@
+import os
+
+# gitlab_tokens reads these at import time, so they must be set before any test module imports it.
+os.environ.setdefault("GITLAB_ADMIN_TOKEN", "test-token")
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def restore_module_config(monkeypatch):
+    # The FakeGitLab tests repoint the module at a local server; undo that after each test.
+    import gitlab_tokens
+
+    for name in ("GITLAB_BASE_URL", "GITLAB_API_URL", "MAX_WORKERS", "RATE_LIMIT_RPS"):
+        monkeypatch.setattr(gitlab_tokens, name, getattr(gitlab_tokens, name))
@@ -0,0 +1,273 @@
+"""Local stand-in for the GitLab REST API used by the tests and the benchmark harness."""
+import datetime
+import hashlib
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlsplit
+
+# Offsets (in days from today) cycled through when generating token expiry dates.
+# Only the 5-day bucket is inside the 30-day threshold; None means "never expires".
+EXPIRY_OFFSETS = (5, 60, 200, None)
+
+
+class FakeGitLab:
+    def __init__(self, projects=100, groups=10, tokens=2, personal_tokens=50, latency=0.0,
+                 throttle_every=0, max_per_page=100, revoked_every=7):
+        self.projects = projects
+        self.groups = groups
+        self.tokens = tokens
+        self.personal_tokens = personal_tokens
+        self.latency = latency
+        self.throttle_every = throttle_every
+        self.max_per_page = max_per_page
+        self.revoked_every = revoked_every
+        self.today = datetime.date.today()
+        self.lock = threading.Lock()
+        self.request_count = 0
+        self.throttled = 0
+        self.not_modified = 0
+        self.endpoint_counts = {}
+        # (kind, id) pairs whose access tokens answer 403, as for entities the admin token cannot read.
+        self.forbidden = set()
+        self.server = None
+
+    # --- synthetic data -------------------------------------------------
+
+    def token(self, token_id, name):
+        offset = EXPIRY_OFFSETS[token_id % len(EXPIRY_OFFSETS)]
+        expires_at = (self.today + datetime.timedelta(days=offset)).isoformat() if offset is not None else None
+        revoked = bool(self.revoked_every) and token_id % self.revoked_every == 0
+        return {
+            "id": token_id,
+            "name": name,
+            "revoked": revoked,
+            "active": not revoked,
+            "scopes": ["api", "read_repository"],
+            "created_at": "2024-01-01T00:00:00.000Z",
+            "last_used_at": None,
+            "expires_at": expires_at,
+        }
+
+    def project(self, project_id):
+        group_id = self.project_group(project_id)
+        return {
+            "id": project_id,
+            "name": f"project{project_id}",
+            "path_with_namespace": f"group{group_id}/project{project_id}",
+            "namespace": {"id": group_id, "kind": "group", "full_path": f"group{group_id}"},
+            "archived": False,
+            "description": "Synthetic project " * 10,
+            "default_branch": "main",
+            "visibility": "private",
+            "topics": ["synthetic", "benchmark"],
+            "last_activity_at": "2024-01-01T00:00:00.000Z",
+        }
+
+    def group(self, group_id):
+        return {
+            "id": group_id,
+            "name": f"group{group_id}",
+            "full_path": f"group{group_id}",
+            "description": "Synthetic group " * 10,
+            "visibility": "private",
+        }
+
+    def project_group(self, project_id):
+        return project_id % max(self.groups, 1) + 1
+
+    def parent_group(self, group_id):
+        """Groups form a binary tree: group g is a subgroup of g // 2, and group 1 is the top."""
+        return group_id // 2 or None
+
+    def subtree(self, root_id):
+        groups = [g for g in range(1, self.groups + 1) if self._descends_from(g, root_id)]
+        members = set(groups)
+        projects = [p for p in range(1, self.projects + 1) if self.project_group(p) in members]
+        return groups, projects
+
+    def _descends_from(self, group_id, root_id):
+        while group_id:
+            if group_id == root_id:
+                return True
+            group_id = self.parent_group(group_id)
+        return False
+
+    def entity_tokens(self, kind, entity_id):
+        base = (1_000_000 if kind == "groups" else 0) + entity_id * self.tokens
+        return [self.token(base + k, f"{kind[:-1]}-{entity_id}-bot-{k}") for k in range(self.tokens)]
+
+    def personal_token_list(self):
+        tokens = []
+        for i in range(1, self.personal_tokens + 1):
+            token = self.token(2_000_000 + i, f"personal-{i}")
+            token["user"] = {"username": f"user{i}", "email": f"user{i}@example.com"}
+            tokens.append(token)
+        return tokens
+
+    def all_tokens(self):
+        for project_id in range(1, self.projects + 1):
+            yield from self.entity_tokens("projects", project_id)
+        for group_id in range(1, self.groups + 1):
+            yield from self.entity_tokens("groups", group_id)
+        yield from self.personal_token_list()
+
+    def expected_expiring(self, root_groups=None):
+        if root_groups is None:
+            tokens = self.all_tokens()
+        else:
+            tokens = []
+            for root_id in root_groups:
+                groups, projects = self.subtree(root_id)
+                tokens += [t for g in groups for t in self.entity_tokens("groups", g)]
+                tokens += [t for p in projects for t in self.entity_tokens("projects", p)]
+            tokens = list({t["id"]: t for t in tokens}.values())
+        return sum(
+            1 for token in tokens
+            if token["active"] and token["expires_at"] and token["id"] % len(EXPIRY_OFFSETS) == 0
+        )
+
+    # --- HTTP -----------------------------------------------------------
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server.server_port}"
+
+    def start(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _count(self, endpoint):
+        with self.lock:
+            self.request_count += 1
+            self.endpoint_counts[endpoint] = self.endpoint_counts.get(endpoint, 0) + 1
+            throttle = bool(self.throttle_every) and self.request_count % self.throttle_every == 0
+            if throttle:
+                self.throttled += 1
+            return throttle
+
+    def _route(self, path, query):
+        parts = path.removeprefix("/api/v4/").strip("/").split("/")
+        if parts == ["projects"]:
+            ids = list(range(1, self.projects + 1))
+            return "projects", self._listing(path, query, ids, self.project, keyset=True)
+        if parts == ["groups"]:
+            ids = list(range(1, self.groups + 1))
+            return "groups", self._listing(path, query, ids, self.group)
+        if parts == ["personal_access_tokens"]:
+            tokens = self.personal_token_list()
+            if query.get("state") == "active":
+                tokens = [t for t in tokens if t["active"]]
+            if query.get("revoked") == "false":
+                tokens = [t for t in tokens if not t["revoked"]]
+            if query.get("expires_before"):
+                tokens = [t for t in tokens if t["expires_at"] and t["expires_at"] < query["expires_before"]]
+            by_id = {t["id"]: t for t in tokens}
+            return "personal_access_tokens", self._listing(path, query, list(by_id), by_id.get)
+        if len(parts) >= 2 and parts[0] == "groups" and parts[1].isdigit() and parts[2:] != ["access_tokens"]:
+            group_id = int(parts[1])
+            if not 1 <= group_id <= self.groups:
+                return "groups/:id", (404, {}, {"message": "404 Group Not Found"})
+            groups, projects = self.subtree(group_id)
+            if parts[2:] == []:
+                return "groups/:id", (200, {}, self.group(group_id))
+            if parts[2:] == ["descendant_groups"]:
+                descendants = [g for g in groups if g != group_id]
+                return "groups/:id/descendant_groups", self._listing(path, query, descendants, self.group)
+            if parts[2:] == ["projects"]:
+                if query.get("include_subgroups") != "true":
+                    projects = [p for p in projects if self.project_group(p) == group_id]
+                return "groups/:id/projects", self._listing(path, query, projects, self.project)
+        if len(parts) == 3 and parts[0] in ("projects", "groups") and parts[2] == "access_tokens":
+            kind, entity_id = parts[0], int(parts[1])
+            limit = self.projects if kind == "projects" else self.groups
+            if not 1 <= entity_id <= limit:
+                return f"{kind}/:id/access_tokens", (404, {}, {"message": "404 Not Found"})
+            if (kind, entity_id) in self.forbidden:
+                return f"{kind}/:id/access_tokens", (403, {}, {"message": "403 Forbidden"})
+            return f"{kind}/:id/access_tokens", (200, {}, self.entity_tokens(kind, entity_id))
+        return "unknown", (404, {}, {"message": "404 Not Found"})
+
+    def _listing(self, path, query, ids, build, keyset=False):
+        per_page = min(int(query.get("per_page", 20)), self.max_per_page)
+        if keyset and query.get("pagination") == "keyset":
+            id_after = int(query.get("id_after", 0))
+            remaining = [i for i in ids if i > id_after]
+            page_ids = remaining[:per_page]
+            headers = {}
+            if len(remaining) > per_page:
+                next_query = {**query, "id_after": page_ids[-1]}
+                headers["Link"] = f'<{self.url}{path}?{urlencode(next_query)}>; rel="next"'
+            return 200, headers, [build(i) for i in page_ids]
+
+        page = int(query.get("page", 1))
+        total_pages = max((len(ids) + per_page - 1) // per_page, 1)
+        page_ids = ids[(page - 1) * per_page:page * per_page]
+        headers = {
+            "X-Page": str(page),
+            "X-Per-Page": str(per_page),
+            "X-Total": str(len(ids)),
+            "X-Total-Pages": str(total_pages),
+            "X-Next-Page": str(page + 1) if page < total_pages else "",
+        }
+        return 200, headers, [build(i) for i in page_ids]
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def _send(self, status, headers, payload):
+                body = json.dumps(payload).encode()
+                if status == 200:
+                    etag = f'W/"{hashlib.md5(body).hexdigest()}"'
+                    if self.headers.get("If-None-Match") == etag:
+                        with fake.lock:
+                            fake.not_modified += 1
+                        status, body = 304, b""
+                    headers = {**headers, "ETag": etag}
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                split = urlsplit(self.path)
+                query = {key: values[-1] for key, values in parse_qs(split.query).items()}
+                endpoint, (status, headers, payload) = fake._route(split.path, query)
+                throttle = fake._count(endpoint)
+                if fake.latency:
+                    time.sleep(fake.latency)
+                if throttle:
+                    self._send(429, {"Retry-After": "0.01"}, {"message": "429 Too Many Requests"})
+                    return
+                self._send(status, headers, payload)
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                self.rfile.read(length)
+                fake._count("graphql")
+                self._send(400, {}, {"errors": [{"message": "GraphQL is not simulated"}]})
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
@@ -0,0 +1,44 @@
+import gitlab_tokens
+from benchmark import available_decoders, decoder_benchmark, run_benchmark
+from fake_gitlab import FakeGitLab
+
+
+def test_scan_uses_one_request_per_page_and_entity():
+    with FakeGitLab(projects=250, groups=30, personal_tokens=120) as fake:
+        report = run_benchmark(fake, workers=4)
+
+    assert report["status"] == "ok"
+    assert report["rate_limit_rps"] == gitlab_tokens.RATE_LIMIT_RPS
+    assert report["tokens_found"] == report["tokens_expected"]
+    assert report["endpoints"] == {
+        "groups": 1,
+        "groups/:id/access_tokens": 30,
+        "personal_access_tokens": 1,
+        "projects": 3,
+        "projects/:id/access_tokens": 250,
+    }
+    assert report["metrics"]["requests"] == 285
+    assert set(report["metrics"]["phases_s"]) == {"personal_tokens", "project_tokens", "group_tokens"}
+
+
+def test_scan_survives_throttling_without_losing_tokens():
+    with FakeGitLab(projects=120, groups=20, personal_tokens=60, throttle_every=9, max_per_page=20) as fake:
+        report = run_benchmark(fake, workers=4)
+
+    assert report["status"] == "ok"
+    assert report["throttled"] > 0
+    assert report["tokens_found"] == report["tokens_expected"]
+
+
+def test_json_decoders_agree_on_project_pages():
+    report = decoder_benchmark(FakeGitLab(groups=10), pages=5)
+
+    assert set(report) == set(available_decoders())
+    reference = report["json"]["page"]
+    for backend, result in report.items():
+        page = result["page"]
+        assert [(p["id"], p["path_with_namespace"], p["namespace"]["kind"]) for p in page] == [
+            (p["id"], p["path_with_namespace"], p["namespace"]["kind"]) for p in reference
+        ], backend
+    if "msgspec" in report:
+        assert set(report["msgspec"]["page"][0]) == {"id", "path_with_namespace", "namespace"}
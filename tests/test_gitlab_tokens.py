@@ -1,10 +1,30 @@
 import pytest
 import datetime
+import json
+import os
+import subprocess
+import sys
+import time
 from unittest.mock import patch, MagicMock
 
+import requests
+
 import gitlab_tokens  # Импортируем правильный модуль
 
 
+@pytest.fixture
+def scanner():
+    return gitlab_tokens.TokenScanner(rate=0)
+
+
+def json_response(data, status_code=200, headers=None):
+    resp = requests.Response()
+    resp.status_code = status_code
+    resp._content = json.dumps(data).encode()
+    resp.headers.update(headers or {})
+    return resp
+
+
 @pytest.mark.parametrize("expires_at,expected", [
     ("2099-01-01", False),  # далеко в будущем
     ((datetime.datetime.utcnow() + datetime.timedelta(days=5)).strftime("%Y-%m-%d"), True),  # скоро истекает
@@ -12,39 +32,58 @@ import gitlab_tokens  # Импортируем правильный модуль
     (None, False),  # нет даты
     ("∞", False),  # бесконечный токен
 ])
-def test_check_expiration(expires_at, expected):
-    assert gitlab_tokens.check_expiration(expires_at) == expected
+def test_is_expiring(expires_at, expected):
+    assert gitlab_tokens.is_expiring({"expires_at": expires_at}, gitlab_tokens.ExpiryEvaluator()) == expected
 
 
-@patch('gitlab_tokens.requests.get')
-def test_get_all_projects(mock_get):
-    mock_get.return_value.status_code = 200
-    mock_get.return_value.json.side_effect = [
-        [{'id': 1, 'path_with_namespace': 'group/project'}],  # первая страница
-        []  # вторая страница пустая
-    ]
+@patch('gitlab_tokens.requests.Session.get')
+def test_paginated_get_projects(mock_get, scanner):
+    mock_get.return_value = json_response([{'id': 1, 'path_with_namespace': 'group/project'}])
 
-    projects = gitlab_tokens.get_all_projects()
+    projects = list(scanner.paginated_get("projects"))
     assert len(projects) == 1
     assert projects[0]['id'] == 1
 
 
-@patch('gitlab_tokens.requests.get')
-def test_get_all_groups(mock_get):
-    mock_get.return_value.status_code = 200
-    mock_get.return_value.json.side_effect = [
-        [{'id': 1, 'full_path': 'group'}],
-        []
-    ]
+@patch('gitlab_tokens.requests.Session.get')
+def test_paginated_get_groups(mock_get, scanner):
+    mock_get.return_value = json_response([{'id': 1, 'full_path': 'group'}], headers={"X-Next-Page": ""})
 
-    groups = gitlab_tokens.get_all_groups()
+    groups = list(scanner.paginated_get("groups"))
     assert len(groups) == 1
     assert groups[0]['id'] == 1
 
 
-@patch('gitlab_tokens.requests.get')
-@patch('gitlab_tokens.print_token')
-def test_check_personal_tokens(mock_print_token, mock_get):
+@patch('gitlab_tokens.requests.Session.get')
+def test_html_error_page_ends_the_listing_instead_of_the_run(mock_get, scanner):
+    html = requests.Response()
+    html.status_code, html._content = 200, b"<html>ngrok gateway error</html>"
+    mock_get.return_value = html
+
+    assert list(scanner.paginated_get("groups")) == []
+    assert scanner.listing_failures == 1
+    assert scanner.fetch_access_tokens("projects", {"id": 1}) == ({"id": 1}, None)
+
+
+@patch('gitlab_tokens.requests.Session.get')
+def test_prefetched_page_failure_is_counted_and_later_pages_read(mock_get, scanner, monkeypatch):
+    monkeypatch.setattr(gitlab_tokens, "MAX_RETRIES", 0)
+
+    def get_side_effect(url, params=None, timeout=None):
+        page = params["page"]
+        if page == 2:
+            return json_response({"message": "500"}, status_code=500)
+        return json_response([{'id': page, 'full_path': f'group{page}'}], headers={"X-Total-Pages": "3"})
+
+    mock_get.side_effect = get_side_effect
+
+    assert [g['id'] for g in scanner.paginated_get("groups")] == [1, 3]
+    assert scanner.listing_failures == 1
+
+
+@patch('gitlab_tokens.requests.Session.get')
+@patch.object(gitlab_tokens.TokenScanner, 'print_token')
+def test_check_personal_tokens(mock_print_token, mock_get, scanner):
     token_data = [{
         "id": 123,
         "name": "test token",
@@ -60,12 +99,9 @@ def test_check_personal_tokens(mock_print_token, mock_get):
         }
     }]
 
-    mock_get.return_value.status_code = 200
-    mock_get.return_value.json.side_effect = [token_data, []]
+    mock_get.return_value = json_response(token_data, headers={"X-Next-Page": ""})
 
-    gitlab_tokens.seen_tokens.clear()
-    gitlab_tokens.tokens_printed = 0
-    gitlab_tokens.check_personal_tokens()
+    scanner.check_personal_tokens()
 
     mock_print_token.assert_called()
     args, kwargs = mock_print_token.call_args
@@ -76,9 +112,9 @@ def test_check_personal_tokens(mock_print_token, mock_get):
     assert "testuser" in label
 
 
-@patch('gitlab_tokens.requests.get')
-@patch('gitlab_tokens.print_token')
-def test_check_project_tokens(mock_print_token, mock_get):
+@patch('gitlab_tokens.requests.Session.get')
+@patch.object(gitlab_tokens.TokenScanner, 'print_token')
+def test_check_project_tokens(mock_print_token, mock_get, scanner):
     project_response = [{'id': 1, 'path_with_namespace': 'group/project'}]
     token_response = [{
         "id": 456,
@@ -91,25 +127,17 @@ def test_check_project_tokens(mock_print_token, mock_get):
         "revoked": False
     }]
 
-    def side_effect(url, headers, timeout):
-        if 'projects?' in url:
-            mock = MagicMock()
-            mock.status_code = 200
-            mock.json.return_value = project_response
-            return mock
+    def side_effect(url, params=None, timeout=None):
+        if url.endswith('/projects'):
+            return json_response(project_response)
         elif 'access_tokens' in url:
-            mock = MagicMock()
-            mock.status_code = 200
-            mock.json.return_value = token_response
-            return mock
+            return json_response(token_response)
         else:
-            return MagicMock(status_code=404)
+            return json_response({}, status_code=404)
 
     mock_get.side_effect = side_effect
 
-    gitlab_tokens.seen_tokens.clear()
-    gitlab_tokens.tokens_printed = 0
-    gitlab_tokens.check_project_tokens()
+    scanner.check_project_tokens()
 
     mock_print_token.assert_called()
     args, kwargs = mock_print_token.call_args
@@ -120,9 +148,9 @@ def test_check_project_tokens(mock_print_token, mock_get):
     assert label == "Project"
 
 
-@patch('gitlab_tokens.requests.get')
-@patch('gitlab_tokens.print_token')
-def test_check_group_tokens(mock_print_token, mock_get):
+@patch('gitlab_tokens.requests.Session.get')
+@patch.object(gitlab_tokens.TokenScanner, 'print_token')
+def test_check_group_tokens(mock_print_token, mock_get, scanner):
     group_response = [{'id': 2, 'full_path': 'groupname'}]
     token_response = [{
         "id": 789,
@@ -135,25 +163,17 @@ def test_check_group_tokens(mock_print_token, mock_get):
         "revoked": False
     }]
 
-    def side_effect(url, headers, timeout):
-        if 'groups?' in url:
-            mock = MagicMock()
-            mock.status_code = 200
-            mock.json.return_value = group_response
-            return mock
+    def side_effect(url, params=None, timeout=None):
+        if url.endswith('/groups'):
+            return json_response(group_response, headers={"X-Next-Page": ""})
         elif 'access_tokens' in url:
-            mock = MagicMock()
-            mock.status_code = 200
-            mock.json.return_value = token_response
-            return mock
+            return json_response(token_response)
         else:
-            return MagicMock(status_code=404)
+            return json_response({}, status_code=404)
 
     mock_get.side_effect = side_effect
 
-    gitlab_tokens.seen_tokens.clear()
-    gitlab_tokens.tokens_printed = 0
-    gitlab_tokens.check_group_tokens()
+    scanner.check_group_tokens()
 
     mock_print_token.assert_called()
     args, kwargs = mock_print_token.call_args
@@ -162,3 +182,547 @@ def test_check_group_tokens(mock_print_token, mock_get):
 
     assert token['id'] == 789
     assert label == "Group"
+
+
+def test_ordered_map_preserves_input_order():
+    import time
+
+    def slow_identity(n):
+        time.sleep(0.001 * (10 - n))
+        return n
+
+    assert list(gitlab_tokens.ordered_map(slow_identity, range(10), max_workers=4)) == list(range(10))
+
+
+@patch('gitlab_tokens.requests.Session.get')
+@patch.object(gitlab_tokens.TokenScanner, 'print_token')
+def test_check_project_tokens_keeps_listing_order(mock_print_token, mock_get, scanner):
+    project_response = [{'id': i, 'path_with_namespace': f'group/project{i}'} for i in range(1, 21)]
+    expires_at = (datetime.datetime.utcnow() + datetime.timedelta(days=5)).strftime("%Y-%m-%d")
+
+    def side_effect(url, params=None, timeout=None):
+        if url.endswith('/projects'):
+            return json_response(project_response)
+        project_id = int(url.split('/')[-2])
+        return json_response([{"id": project_id * 100, "name": "t", "expires_at": expires_at}])
+
+    mock_get.side_effect = side_effect
+
+    scanner.check_project_tokens()
+
+    printed_ids = [c.args[0]['id'] for c in mock_print_token.call_args_list]
+    assert printed_ids == [i * 100 for i in range(1, 21)]
+
+
+def test_client_reuses_pooled_connections():
+    import threading
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            body = b"[]"
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        client = gitlab_tokens.GitLabClient(f"http://127.0.0.1:{server.server_port}/api/v4", {"PRIVATE-TOKEN": "x"})
+        for _ in range(3):
+            assert client.get("projects").json() == []
+        assert client.connection_stats() == {"requests": 3, "connections_opened": 1, "connections_reused": 2}
+    finally:
+        server.shutdown()
+
+
+@patch('gitlab_tokens.requests.Session.get')
+def test_paginated_get_follows_keyset_link_header(mock_get, scanner):
+    next_url = "https://gitlab.example/api/v4/projects?id_after=2&pagination=keyset"
+    mock_get.side_effect = [
+        json_response([{'id': 1}, {'id': 2}], headers={"Link": f'<{next_url}>; rel="next"'}),
+        json_response([{'id': 3}]),
+    ]
+
+    projects = list(scanner.paginated_get("projects"))
+
+    assert [p['id'] for p in projects] == [1, 2, 3]
+    assert mock_get.call_count == 2
+    first_params = mock_get.call_args_list[0].kwargs['params']
+    assert first_params['pagination'] == "keyset" and first_params['order_by'] == "id"
+    assert mock_get.call_args_list[1].args[0] == next_url
+
+
+@patch('gitlab_tokens.requests.Session.get')
+def test_paginated_get_offset_stops_on_empty_next_page_header(mock_get, scanner):
+    mock_get.side_effect = [
+        json_response([{'id': 1}], headers={"X-Next-Page": "2"}),
+        json_response([{'id': 2}], headers={"X-Next-Page": ""}),
+    ]
+
+    groups = list(scanner.paginated_get("groups"))
+
+    assert [g['id'] for g in groups] == [1, 2]
+    assert [c.kwargs['params']['page'] for c in mock_get.call_args_list] == [1, 2]
+
+
+@patch('gitlab_tokens.requests.Session.get')
+def test_paginated_get_falls_back_to_offset_when_keyset_rejected(mock_get, scanner):
+    mock_get.side_effect = [
+        json_response({"error": "keyset pagination is not supported"}, status_code=400),
+        json_response([{'id': 1}], headers={"X-Next-Page": ""}),
+    ]
+
+    projects = list(scanner.paginated_get("projects"))
+
+    assert [p['id'] for p in projects] == [1]
+    assert 'pagination' not in mock_get.call_args_list[1].kwargs['params']
+
+
+@patch('gitlab_tokens.requests.Session.get')
+def test_paginated_get_prefetches_remaining_pages_in_order(mock_get, scanner):
+    def side_effect(url, params=None, timeout=None):
+        page = params['page']
+        headers = {"X-Total-Pages": "5", "X-Next-Page": str(page + 1) if page < 5 else ""}
+        return json_response([{'id': page}], headers=headers)
+
+    mock_get.side_effect = side_effect
+
+    groups = list(scanner.paginated_get("groups", prefetch=True))
+
+    assert [g['id'] for g in groups] == [1, 2, 3, 4, 5]
+    assert sorted(c.kwargs['params']['page'] for c in mock_get.call_args_list) == [1, 2, 3, 4, 5]
+
+
+@patch('gitlab_tokens.requests.Session.get')
+def test_paginated_get_follows_offset_link_header_without_next_page(mock_get, scanner):
+    next_url = "https://gitlab.example/api/v4/groups?page=2&per_page=100"
+    mock_get.side_effect = [
+        json_response([{'id': 1}], headers={"Link": f'<{next_url}>; rel="next"'}),
+        json_response([{'id': 2}], headers={"X-Total-Pages": "2", "X-Next-Page": ""}),
+    ]
+
+    groups = list(scanner.paginated_get("groups", prefetch=True))
+
+    assert [g['id'] for g in groups] == [1, 2]
+    assert mock_get.call_args_list[1].args[0] == next_url
+
+
+@patch('gitlab_tokens.requests.Session.get')
+def test_paginated_get_streams_slim_entities(mock_get, scanner):
+    mock_get.side_effect = [
+        json_response([{'id': 1, 'full_path': 'a/b', 'description': 'x' * 1000}], headers={"X-Next-Page": "2"}),
+        json_response([{'id': 2, 'full_path': 'a/c', 'description': 'y' * 1000}], headers={"X-Next-Page": ""}),
+    ]
+
+    listing = scanner.paginated_get("groups", prefetch=False, fields=("id", "full_path"))
+
+    assert next(listing) == {'id': 1, 'full_path': 'a/b'}
+    assert mock_get.call_count == 1
+    assert list(listing) == [{'id': 2, 'full_path': 'a/c'}]
+
+
+def test_background_iter_propagates_errors():
+    def failing():
+        yield 1
+        raise RuntimeError("listing failed")
+
+    items = gitlab_tokens.background_iter(failing())
+    assert next(items) == 1
+    with pytest.raises(RuntimeError):
+        next(items)
+
+
+@patch('gitlab_tokens.requests.Session.get')
+@patch.object(gitlab_tokens.TokenScanner, 'print_token')
+def test_check_personal_tokens_pushes_filters_to_server(mock_print_token, mock_get, scanner):
+    far_future = {"id": 1, "name": "old", "expires_at": "2999-01-01", "active": True, "user": {"username": "u"}}
+    mock_get.return_value = json_response([far_future], headers={"X-Next-Page": ""})
+
+    scanner.check_personal_tokens()
+
+    params = mock_get.call_args.kwargs['params']
+    assert params['state'] == "active"
+    assert params['revoked'] == "false"
+    expires_before = datetime.date.fromisoformat(params['expires_before'])
+    assert expires_before > datetime.date.today() + datetime.timedelta(days=gitlab_tokens.EXPIRY_THRESHOLD_DAYS)
+    mock_print_token.assert_not_called()
+
+
+@patch('gitlab_tokens.requests.Session.get')
+@patch.object(gitlab_tokens.TokenScanner, 'print_token')
+def test_check_project_tokens_prefilters_and_learns_denylist(mock_print_token, mock_get, tmp_path, scanner):
+    project_response = [
+        {'id': 1, 'path_with_namespace': 'group/one', 'namespace': {'kind': 'group'}},
+        {'id': 2, 'path_with_namespace': 'user/two', 'namespace': {'kind': 'user'}},
+        {'id': 3, 'path_with_namespace': 'group/three', 'namespace': {'kind': 'group'}},
+    ]
+
+    def side_effect(url, params=None, timeout=None):
+        if url.endswith('/projects'):
+            assert params['archived'] == "false"
+            return json_response(project_response)
+        if '/projects/3/' in url:
+            return json_response({"message": "403 Forbidden"}, status_code=403)
+        return json_response([])
+
+    mock_get.side_effect = side_effect
+
+    scanner.check_project_tokens()
+    assert scanner.entities_skipped == 1
+    assert "projects/3" in scanner.denylist
+
+    path = tmp_path / "denylist.json"
+    scanner.save_denylist(str(path))
+    scanner.denylist.clear()
+    scanner.load_denylist(str(path))
+
+    scanner.check_project_tokens()
+    assert scanner.entities_skipped == 3
+    token_urls = [c.args[0] for c in mock_get.call_args_list if 'access_tokens' in c.args[0]]
+    assert sorted(u.split('/')[-2] for u in token_urls) == ['1', '1', '3']
+    scanner.denylist.clear()
+
+
+def test_file_store_roundtrip(tmp_path):
+    store = gitlab_tokens.open_store(str(tmp_path / "state"))
+
+    assert store.get("checkpoint.json") is None
+    store.put("checkpoint.json", {"last_scan": "2026-01-01T00:00:00+00:00"})
+    assert store.get("checkpoint.json") == {"last_scan": "2026-01-01T00:00:00+00:00"}
+    store.delete("checkpoint.json")
+    assert store.get("checkpoint.json") is None
+
+
+@patch('gitlab_tokens.requests.Session.get')
+@patch.object(gitlab_tokens.TokenScanner, 'print_token')
+def test_incremental_scan_replays_cached_project_tokens(mock_print_token, mock_get, tmp_path, monkeypatch):
+    expires_at = (datetime.datetime.utcnow() + datetime.timedelta(days=5)).strftime("%Y-%m-%d")
+    token = {"id": 456, "name": "project token", "scopes": ["api"], "expires_at": expires_at, "active": True}
+    listed_params = []
+
+    def side_effect(url, params=None, timeout=None):
+        if url.endswith('/projects'):
+            listed_params.append(params)
+            if 'last_activity_after' in params:
+                return json_response([])
+            return json_response([{'id': 1, 'path_with_namespace': 'group/project'}])
+        if '/projects/1/access_tokens' in url:
+            return json_response([token])
+        return json_response([], headers={"X-Next-Page": ""})
+
+    mock_get.side_effect = side_effect
+    monkeypatch.setattr(gitlab_tokens, "CHECKPOINT_STORE", str(tmp_path))
+    monkeypatch.setattr(gitlab_tokens, "INCREMENTAL_SCAN", True)
+    monkeypatch.setattr(gitlab_tokens, "send_slack_notification", MagicMock())
+
+    assert gitlab_tokens.lambda_handler()["status"] == "ok"
+    assert 'last_activity_after' not in listed_params[-1]
+    checkpoint = gitlab_tokens.FileStore(str(tmp_path)).get("checkpoint.json")
+    assert checkpoint["entities"]["projects/1"]["earliest_expiry"] == expires_at
+
+    mock_print_token.reset_mock()
+    assert gitlab_tokens.lambda_handler()["status"] == "ok"
+    assert listed_params[-1]['last_activity_after'] == checkpoint["last_scan"]
+    assert mock_print_token.call_args.args[0]['id'] == 456
+    assert mock_print_token.call_args.kwargs['link'].endswith('/group/project')
+
+
+@patch('gitlab_tokens.requests.Session.get')
+def test_client_retries_throttled_requests(mock_get, monkeypatch):
+    monkeypatch.setattr(gitlab_tokens, "BACKOFF_BASE", 0.01)
+    mock_get.side_effect = [
+        json_response({"message": "429 Too Many Requests"}, status_code=429, headers={"Retry-After": "0.2"}),
+        json_response({"message": "502 Bad Gateway"}, status_code=502),
+        json_response([{'id': 1}]),
+    ]
+    limiter = gitlab_tokens.RateLimiter(rate=0)
+    client = gitlab_tokens.GitLabClient("https://gitlab.example/api/v4", {}, limiter=limiter)
+
+    started = time.monotonic()
+    resp = client.get("projects")
+
+    assert resp.status_code == 200
+    assert client.metrics.retries == 2
+    assert time.monotonic() - started >= 0.2
+    assert limiter.paused_until > started
+
+
+def test_rate_limiter_pauses_when_remaining_budget_is_low(monkeypatch):
+    limiter = gitlab_tokens.RateLimiter(rate=0)
+    limiter.observe({"RateLimit-Remaining": "3", "RateLimit-Reset": str(time.time() + 30)})
+    assert limiter.paused_until - time.monotonic() > 25
+
+    limiter = gitlab_tokens.RateLimiter(rate=0)
+    limiter.observe({"RateLimit-Remaining": "500", "RateLimit-Reset": str(time.time() + 30)})
+    assert limiter.paused_until == 0.0
+
+
+@patch('gitlab_tokens.requests.Session.post')
+@patch('gitlab_tokens.requests.Session.get')
+@patch.object(gitlab_tokens.TokenScanner, 'print_token')
+def test_graphql_backend_only_fetches_entities_with_bot_members(mock_print_token, mock_get, mock_post, monkeypatch, scanner):
+    monkeypatch.setattr(gitlab_tokens, "FETCH_BACKEND", "graphql")
+    expires_at = (datetime.datetime.utcnow() + datetime.timedelta(days=5)).strftime("%Y-%m-%d")
+    project_response = [{'id': i, 'path_with_namespace': f'group/project{i}'} for i in (1, 2, 3)]
+
+    def get_side_effect(url, params=None, timeout=None):
+        if url.endswith('/projects'):
+            return json_response(project_response)
+        project_id = int(url.split('/')[-2])
+        return json_response([{"id": project_id * 10, "name": "bot token", "expires_at": expires_at}])
+
+    mock_get.side_effect = get_side_effect
+    mock_post.return_value = json_response({"data": {
+        "e0": {"projectMembers": {"nodes": [{"user": {"bot": True}}], "pageInfo": {"hasNextPage": False}}},
+        "e1": {"projectMembers": {"nodes": [{"user": {"bot": False}}], "pageInfo": {"hasNextPage": False}}},
+        "e2": {"projectMembers": {"nodes": [], "pageInfo": {"hasNextPage": True}}},
+    }})
+
+    scanner.check_project_tokens()
+
+    variables = mock_post.call_args.kwargs['json']['variables']
+    assert variables == {"p0": "group/project1", "p1": "group/project2", "p2": "group/project3"}
+    assert mock_post.call_args.args[0].endswith('/api/graphql')
+    assert [c.args[0]['id'] for c in mock_print_token.call_args_list] == [10, 30]
+    assert scanner.entities_skipped == 1
+
+
+@patch('gitlab_tokens.requests.Session.post')
+def test_graphql_screening_keeps_entities_whose_alias_failed(mock_post, scanner):
+    projects = [{'id': i, 'path_with_namespace': f'group/project{i}'} for i in (1, 2, 3)]
+    mock_post.return_value = json_response({
+        "data": {
+            "e0": {"projectMembers": {"nodes": [{"user": {"bot": True}}], "pageInfo": {"hasNextPage": False}}},
+            "e1": None,
+            "e2": {"projectMembers": None},
+        },
+        "errors": [{"message": "Timeout", "path": ["e1"]}, {"message": "Forbidden", "path": ["e2", "projectMembers"]}],
+    })
+
+    assert [p['id'] for p in scanner.screen_bot_members("projects", projects)] == [1, 2, 3]
+
+
+def test_metrics_summary_groups_requests_by_endpoint():
+    metrics = gitlab_tokens.Metrics()
+    with metrics.phase("project_tokens"):
+        for i in range(1, 101):
+            metrics.observe(f"https://gitlab.example/api/v4/projects/{i}/access_tokens", i / 1000, 10)
+        metrics.observe("https://gitlab.example/api/v4/projects?per_page=100", 0.5, 1000)
+
+    summary = metrics.summary(entities_skipped=3)
+
+    assert summary["requests"] == 101
+    assert summary["bytes_received"] == 2000
+    assert summary["entities_skipped"] == 3
+    assert "project_tokens" in summary["phases_s"]
+    endpoint = summary["endpoints"]["projects/:id/access_tokens"]
+    assert endpoint["requests"] == 100
+    assert 40 <= endpoint["p50"] <= 65
+    assert 90 <= endpoint["p99"] <= 125
+    assert summary["endpoints"]["projects"]["requests"] == 1
+
+
+def test_emit_emf_writes_cloudwatch_document(capsys):
+    metrics = gitlab_tokens.Metrics()
+    with metrics.phase("group_tokens"):
+        metrics.observe("https://gitlab.example/api/v4/groups", 0.01, 100)
+
+    gitlab_tokens.emit_emf(metrics.summary(entities_skipped=0))
+
+    document = json.loads(capsys.readouterr().out)
+    names = {m["Name"]: m["Unit"] for m in document["_aws"]["CloudWatchMetrics"][0]["Metrics"]}
+    assert names["group_tokens_s"] == "Seconds"
+    assert names["requests"] == "Count"
+    assert document["requests"] == 1
+
+
+def test_expiry_evaluator_matches_days_left_semantics():
+    now = datetime.datetime(2026, 3, 10, 15, 30, tzinfo=datetime.timezone.utc)
+    evaluator = gitlab_tokens.ExpiryEvaluator(now=now)
+
+    def reference_days_left(expires_at):
+        expiry_date = datetime.datetime.strptime(expires_at, "%Y-%m-%d").replace(tzinfo=datetime.timezone.utc)
+        return (expiry_date - now).days
+
+    for offset in range(-5, 40):
+        expires_at = (now.date() + datetime.timedelta(days=offset)).isoformat()
+        days_left = reference_days_left(expires_at)
+        assert evaluator.days_left(expires_at) == days_left
+        expected = "expired" if days_left < 0 else "critical" if days_left <= 7 else "warning" if days_left <= 30 else None
+        assert evaluator.severity(expires_at) == expected
+
+
+def test_expiry_evaluator_at_midnight_and_without_expiry():
+    evaluator = gitlab_tokens.ExpiryEvaluator(now=datetime.datetime(2026, 3, 10, tzinfo=datetime.timezone.utc))
+
+    assert evaluator.severity("2026-04-09") == "warning"
+    assert evaluator.severity("2026-04-10") is None
+    assert evaluator.severity(None) is None
+    assert evaluator.severity("∞") is None
+
+
+def test_token_record_round_trips_and_shares_scopes():
+    token = {"id": 7, "name": "deploy", "scopes": ["api", "read_repository"], "expires_at": "2026-04-01",
+             "created_at": "2024-01-01T00:00:00.000Z", "last_used_at": None}
+    record = gitlab_tokens.TokenRecord.from_token(token, "warning", "group/project", "https://gitlab.example/p")
+    other = gitlab_tokens.TokenRecord.from_token({**token, "id": 8}, "warning", "group/project")
+
+    assert record.scopes is other.scopes
+    assert not hasattr(record, "__dict__")
+    assert record.to_dict() == {
+        "id": 7, "name": "deploy", "scopes": ["api", "read_repository"], "expires_at": "2026-04-01",
+        "created_at": "2024-01-01T00:00:00.000Z", "severity": "warning", "source": "group/project",
+        "url": "https://gitlab.example/p", "instance": None,
+    }
+    assert gitlab_tokens.TokenRecord.from_dict(json.loads(json.dumps(record.to_dict()))) == record
+
+
+@patch('gitlab_tokens.requests.post')
+def test_slack_notification_groups_tokens_by_instance(mock_post, monkeypatch):
+    monkeypatch.setattr(gitlab_tokens, "SLACK_WEBHOOK_URL", "https://hooks.slack.example/x")
+    token = {"id": 1, "name": "t", "scopes": ["api"], "expires_at": "2026-04-01"}
+    tokens = [
+        gitlab_tokens.TokenRecord.from_token({**token, "name": "b1"}, "warning", "Project", instance="beta"),
+        gitlab_tokens.TokenRecord.from_token({**token, "name": "a1"}, "warning", "Project", instance="alpha"),
+        gitlab_tokens.TokenRecord.from_token({**token, "name": "b2"}, "critical", "Group", instance="beta"),
+    ]
+    summary = {"tokens_checked": 3, "instances": {
+        "alpha": {"status": "ok", "tokens_checked": 1}, "beta": {"status": "ok", "tokens_checked": 2},
+    }}
+
+    gitlab_tokens.send_slack_notification(summary, tokens)
+
+    sections = [block["text"]["text"] for block in mock_post.call_args.kwargs['json']['blocks']]
+    assert sections[1:] == [
+        "*alpha* (1)",
+        "*Project tokens* (1)\n• *a1* expires on `2026-04-01` (warning)\n  Source: Project\n  Scopes: _api_",
+        "*beta* (2)",
+        "*Group tokens* (1)\n• *b2* expires on `2026-04-01` (critical)\n  Source: Group\n  Scopes: _api_",
+        "*Project tokens* (1)\n• *b1* expires on `2026-04-01` (warning)\n  Source: Project\n  Scopes: _api_",
+    ]
+
+
+def test_slack_report_never_sounds_all_clear_when_an_instance_failed():
+    summary = {
+        "tokens_checked": 0, "timestamp": "2026-01-01T00:00:00",
+        "instances": {"alpha": {"status": "ok", "tokens_checked": 0}, "beta": {"status": "error", "tokens_checked": 0}},
+    }
+
+    [message] = gitlab_tokens.slack_messages(summary, [])
+
+    assert "All GitLab tokens are valid" not in message["text"]
+    assert message["text"].endswith("❌ *Not checked, the scan failed:* beta")
+
+
+def report_tokens(count):
+    sources = ("Project", "Group", "alice <alice@example.com>")
+    return [
+        gitlab_tokens.TokenRecord.from_token(
+            {"id": i, "name": f"token-{i}-" + "x" * 40, "scopes": ["api"], "expires_at": "2026-04-01"},
+            "warning", sources[i % 3], f"https://gitlab.example/group/project{i}" if i % 3 < 2 else None,
+        )
+        for i in range(count)
+    ]
+
+
+def test_slack_report_is_split_into_block_kit_messages_by_source():
+    tokens = report_tokens(900)
+
+    messages = gitlab_tokens.slack_messages({"tokens_checked": 900}, tokens)
+
+    assert len(messages) > 1
+    assert all(len(message["blocks"]) <= gitlab_tokens.SLACK_MAX_BLOCKS for message in messages)
+    assert all(
+        sum(len(block["text"]["text"]) for block in message["blocks"]) <= gitlab_tokens.SLACK_MESSAGE_CHARS
+        for message in messages
+    )
+    sections = [block["text"]["text"] for message in messages for block in message["blocks"]]
+    assert all(len(text) <= gitlab_tokens.SLACK_SECTION_CHARS for text in sections)
+    assert sum(text.count("• ") for text in sections) == 900
+    headings = [text.split("\n", 1)[0] for text in sections[1:] if "(continued)" not in text]
+    assert headings == ["*Group tokens* (300)", "*Personal tokens* (300)", "*Project tokens* (300)"]
+
+
+def test_report_is_split_into_sqs_messages_and_batches():
+    tokens = report_tokens(2000)
+    summary = {"tokens_checked": 2000}
+
+    bodies = gitlab_tokens.report_messages(summary, tokens, max_bytes=64 * 1024)
+    batches = list(gitlab_tokens.sqs_batches(bodies, max_bytes=150 * 1024))
+
+    assert len(bodies) > 1
+    assert all(len(body.encode()) <= 64 * 1024 for body in bodies)
+    parts = [json.loads(body) for body in bodies]
+    assert [part["part"] for part in parts] == list(range(1, len(bodies) + 1))
+    assert all(part["summary"] == summary and part["parts"] == len(bodies) for part in parts)
+    assert [token["id"] for part in parts for token in part["tokens"]] == list(range(2000))
+    assert all(sum(len(body.encode()) for body in batch) <= 150 * 1024 for batch in batches)
+    assert sum(batches, []) == bodies
+
+
+def test_send_message_batch_retries_failed_entries(monkeypatch):
+    sqs = MagicMock()
+    sqs.send_message_batch.side_effect = [
+        {"Successful": [{"Id": "0"}], "Failed": [{"Id": "1", "SenderFault": False, "Code": "InternalError"}]},
+        {"Successful": [{"Id": "1"}], "Failed": []},
+    ]
+    monkeypatch.setattr(gitlab_tokens, "sqs_client", sqs)
+    monkeypatch.setattr(gitlab_tokens.time, "sleep", lambda seconds: None)
+
+    gitlab_tokens.send_message_batch("https://sqs.example/queue", ["first", "second"])
+
+    retried = sqs.send_message_batch.call_args_list[1].kwargs["Entries"]
+    assert retried == [{"Id": "1", "MessageBody": "second"}]
+
+
+def test_response_cache_evicts_least_recently_used_and_separates_tokens(tmp_path):
+    store = gitlab_tokens.FileStore(str(tmp_path))
+    cache = gitlab_tokens.ResponseCache(store, {"PRIVATE-TOKEN": "a"}, max_entries=2)
+    for i in (1, 2, 3):
+        if i == 3:
+            cache.lookup("projects/1/access_tokens")
+        cache.remember(f"projects/{i}/access_tokens", json_response([], headers={"ETag": f'W/"{i}"'}), [])
+
+    assert cache.lookup("projects/2/access_tokens") is None
+    assert cache.conditional_headers(cache.lookup("projects/1/access_tokens")) == {"If-None-Match": 'W/"1"'}
+    assert cache.stats()["evictions"] == 1
+    cache.save()
+
+    other = gitlab_tokens.ResponseCache(store, {"PRIVATE-TOKEN": "b"})
+    other.load()
+    assert other.lookup("projects/1/access_tokens") is None
+    same = gitlab_tokens.ResponseCache(store, {"PRIVATE-TOKEN": "a"})
+    same.load()
+    assert same.hit(same.lookup("projects/3/access_tokens")) == []
+    assert same.stats()["bytes_saved"] == 2
+
+
+# Cold-start budget for `import gitlab_tokens`, dependencies included; boto3 alone used to add ~200 ms.
+IMPORT_BUDGET_MS = float(os.environ.get("IMPORT_BUDGET_MS", "250"))
+
+
+def test_import_stays_within_cold_start_budget():
+    env = {key: value for key, value in os.environ.items() if key != "GITLAB_ADMIN_TOKEN"}
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import gitlab_tokens"],
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        env=env, capture_output=True, text=True, check=True,
+    )
+
+    cumulative_us = {}
+    for line in result.stderr.splitlines():
+        _, _, timings = line.partition("import time:")
+        parts = [part.strip() for part in timings.split("|")]
+        if len(parts) == 3 and parts[1].isdigit():
+            cumulative_us[parts[2]] = int(parts[1])
+
+    assert not {"boto3", "botocore", "multiprocessing", "argparse"} & set(cumulative_us)
+    assert cumulative_us["gitlab_tokens"] / 1000 < IMPORT_BUDGET_MS
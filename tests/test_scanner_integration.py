@@ -0,0 +1,364 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+from unittest.mock import MagicMock
+
+import pytest
+
+import gitlab_tokens
+from benchmark import point_at, run_benchmark
+from fake_gitlab import FakeGitLab
+
+
+def test_warm_container_does_not_dedup_against_previous_invocation(monkeypatch):
+    monkeypatch.setattr(gitlab_tokens, "send_slack_notification", MagicMock())
+
+    with FakeGitLab(projects=40, groups=5, personal_tokens=10) as fake:
+        point_at(fake, workers=4)
+        first = gitlab_tokens.lambda_handler()
+        second = gitlab_tokens.lambda_handler()
+
+    assert first["tokens_checked"] == second["tokens_checked"] == fake.expected_expiring()
+    # The pooled client is reused, but connection counts are reported per run.
+    assert second["connections"]["requests"] == second["metrics"]["requests"] == fake.request_count // 2
+
+
+def test_concurrent_scans_of_one_instance_keep_their_own_metrics(monkeypatch):
+    monkeypatch.setattr(gitlab_tokens, "send_slack_notification", MagicMock())
+
+    with FakeGitLab(projects=40, groups=5, personal_tokens=10) as fake:
+        point_at(fake, workers=4)
+        scanners = [gitlab_tokens.TokenScanner() for _ in range(2)]
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            results = list(pool.map(lambda scanner: scanner.run_scan(), scanners))
+
+    assert scanners[0].client.session is scanners[1].client.session
+    assert [result["metrics"]["requests"] for result in results] == [fake.request_count // 2] * 2
+
+
+def test_scanners_run_concurrently_in_one_process(monkeypatch):
+    monkeypatch.setattr(gitlab_tokens, "send_slack_notification", MagicMock())
+
+    with FakeGitLab(projects=60, groups=8, personal_tokens=10) as a, \
+            FakeGitLab(projects=25, groups=3, personal_tokens=40) as b:
+        scanners = [gitlab_tokens.TokenScanner(base_url=fake.url, max_workers=4, rate=0) for fake in (a, b)]
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            results = list(pool.map(lambda scanner: scanner.run_scan(), scanners))
+
+    assert [r["tokens_checked"] for r in results] == [a.expected_expiring(), b.expected_expiring()]
+    assert all(token.url is None or token.url.startswith(a.url) for token in scanners[0].expiring_tokens)
+    assert all(token.url is None or token.url.startswith(b.url) for token in scanners[1].expiring_tokens)
+
+
+def test_instances_are_scanned_together_into_one_report(monkeypatch):
+    sent = []
+    slack = MagicMock()
+    monkeypatch.setattr(gitlab_tokens, "SQS_QUEUE_URL", "https://sqs.example/queue")
+    monkeypatch.setattr(gitlab_tokens, "send_message", lambda url, body, attributes=None: sent.append(json.loads(body)))
+    monkeypatch.setattr(gitlab_tokens, "send_message_batch", lambda url, bodies: sent.extend(map(json.loads, bodies)))
+    monkeypatch.setattr(gitlab_tokens, "send_slack_notification", slack)
+    monkeypatch.setenv("ALPHA_TOKEN", "alpha-token")
+    monkeypatch.setenv("BETA_TOKEN", "beta-token")
+
+    with FakeGitLab(projects=50, groups=6, personal_tokens=10) as a, \
+            FakeGitLab(projects=20, groups=2, personal_tokens=30) as b:
+        monkeypatch.setattr(gitlab_tokens, "GITLAB_INSTANCES", [
+            {"name": "alpha", "url": a.url, "token_env": "ALPHA_TOKEN", "max_workers": 4, "rate_limit_rps": 0},
+            {"name": "beta", "url": b.url, "token_env": "BETA_TOKEN", "max_workers": 2, "rate_limit_rps": 0},
+        ])
+        result = gitlab_tokens.lambda_handler()
+
+    assert result["status"] == "ok"
+    assert result["tokens_checked"] == a.expected_expiring() + b.expected_expiring()
+    assert slack.call_count == 1 and len(sent) == 1
+    summary = sent[0]["summary"]
+    assert {name: s["tokens_checked"] for name, s in summary["instances"].items()} == {
+        "alpha": a.expected_expiring(), "beta": b.expected_expiring(),
+    }
+    by_instance = {}
+    for token in sent[0]["tokens"]:
+        by_instance[token["instance"]] = by_instance.get(token["instance"], 0) + 1
+    assert by_instance == {"alpha": a.expected_expiring(), "beta": b.expected_expiring()}
+
+
+def test_instance_without_token_does_not_abort_the_others(monkeypatch):
+    slack = MagicMock()
+    errors = MagicMock()
+    monkeypatch.setattr(gitlab_tokens, "send_slack_notification", slack)
+    monkeypatch.setattr(gitlab_tokens, "send_slack_error_notification", errors)
+    monkeypatch.setenv("ALPHA_TOKEN", "alpha-token")
+    monkeypatch.delenv("MISSING_TOKEN", raising=False)
+
+    with FakeGitLab(projects=30, groups=4, personal_tokens=10) as fake:
+        result = gitlab_tokens.scan_instances(gitlab_tokens.load_instances([
+            {"name": "alpha", "url": fake.url, "token_env": "ALPHA_TOKEN", "max_workers": 4, "rate_limit_rps": 0},
+            {"name": "broken", "url": "http://127.0.0.1:9", "token_env": "MISSING_TOKEN"},
+        ]))
+
+    assert result["status"] == "partial"
+    assert result["instances"]["broken"]["status"] == "error"
+    assert result["tokens_checked"] == fake.expected_expiring()
+    summary, tokens = slack.call_args.args
+    assert summary["instances"]["broken"]["status"] == "error"
+    assert "MISSING_TOKEN" in errors.call_args.args[0]
+
+
+def test_no_report_when_every_instance_failed(monkeypatch):
+    slack = MagicMock()
+    batches = MagicMock()
+    monkeypatch.setattr(gitlab_tokens, "SQS_QUEUE_URL", "https://sqs.example/queue")
+    monkeypatch.setattr(gitlab_tokens, "send_slack_notification", slack)
+    monkeypatch.setattr(gitlab_tokens, "send_message_batch", batches)
+    monkeypatch.setattr(gitlab_tokens, "send_slack_error_notification", MagicMock())
+    monkeypatch.setattr(gitlab_tokens, "MAX_RETRIES", 0)
+    monkeypatch.setenv("ALPHA_TOKEN", "alpha-token")
+
+    result = gitlab_tokens.scan_instances(gitlab_tokens.load_instances([
+        {"name": "alpha", "url": "http://127.0.0.1:9", "token_env": "ALPHA_TOKEN", "rate_limit_rps": 0},
+        {"name": "beta", "url": "http://127.0.0.1:9", "token_env": "MISSING_TOKEN"},
+    ]))
+
+    assert result["status"] == "error"
+    slack.assert_not_called()
+    batches.assert_not_called()
+
+
+def test_cli_scans_configured_instances(monkeypatch):
+    slack = MagicMock()
+    monkeypatch.setattr(gitlab_tokens, "send_slack_notification", slack)
+    monkeypatch.setattr(gitlab_tokens, "GITLAB_ADMIN_TOKEN", None)
+    monkeypatch.setenv("ALPHA_TOKEN", "alpha-token")
+
+    with FakeGitLab(projects=20, groups=3, personal_tokens=5) as fake:
+        monkeypatch.setattr(gitlab_tokens, "GITLAB_INSTANCES", [
+            {"name": "alpha", "url": fake.url, "token_env": "ALPHA_TOKEN", "rate_limit_rps": 0},
+        ])
+        assert gitlab_tokens.main(["scan", "--threads", "2"]) == 0
+        with pytest.raises(SystemExit):
+            gitlab_tokens.main(["scan", "--workers", "2"])
+
+    summary, tokens = slack.call_args.args
+    assert summary["instances"]["alpha"]["tokens_checked"] == fake.expected_expiring() == len(tokens)
+
+
+def test_response_cache_revalidates_access_tokens_on_the_next_run(tmp_path, monkeypatch):
+    monkeypatch.setattr(gitlab_tokens, "RESPONSE_CACHE", str(tmp_path))
+    monkeypatch.setattr(gitlab_tokens, "send_slack_notification", MagicMock())
+
+    with FakeGitLab(projects=40, groups=6, personal_tokens=10) as fake:
+        first = run_benchmark(fake, workers=4)
+        second = run_benchmark(fake, workers=4)
+
+    assert first["metrics"]["response_cache"]["hits"] == 0
+    cache = second["metrics"]["response_cache"]
+    assert cache["hits"] == fake.not_modified == 40 + 6
+    assert cache["misses"] == 0 and cache["bytes_saved"] > 0
+    assert second["tokens_found"] == first["tokens_found"] == fake.expected_expiring()
+
+
+def test_warm_listing_cache_only_fetches_new_projects(monkeypatch):
+    listings = gitlab_tokens.ListingCache(ttl=3600)
+    monkeypatch.setattr(gitlab_tokens, "warm_listings", listings)
+    monkeypatch.setattr(gitlab_tokens, "LISTING_CACHE_TTL", 3600)
+    monkeypatch.setattr(gitlab_tokens, "send_slack_notification", MagicMock())
+
+    with FakeGitLab(projects=150, groups=30, personal_tokens=10, max_per_page=50) as fake:
+        first = run_benchmark(fake, workers=4)
+        fake.projects = 180
+        fake.endpoint_counts.clear()
+        second = run_benchmark(fake, workers=4)
+        listings.ttl = 0
+        fake.endpoint_counts.clear()
+        third = run_benchmark(fake, workers=4)
+
+    assert first["endpoints"]["projects"] == 3
+    assert second["endpoints"]["projects"] == 1 and "groups" not in second["endpoints"]
+    assert second["endpoints"]["projects/:id/access_tokens"] == 180
+    assert third["endpoints"]["projects"] == 4 and third["endpoints"]["groups"] == 1
+    assert second["tokens_found"] == third["tokens_found"] == fake.expected_expiring()
+
+
+class CountdownContext:
+    def __init__(self, calls):
+        self.calls = calls
+
+    def get_remaining_time_in_millis(self):
+        self.calls -= 1
+        return 600_000 if self.calls > 0 else 1_000
+
+
+def test_group_tree_scan_checks_each_node_once(monkeypatch):
+    monkeypatch.setattr(gitlab_tokens, "send_slack_notification", MagicMock())
+
+    with FakeGitLab(projects=80, groups=12, personal_tokens=30) as fake:
+        point_at(fake, workers=4)
+        # Group 4 sits below group 2, so its subtree is already covered by the first root.
+        scanner = gitlab_tokens.TokenScanner(root_groups=["2", "4", "3"])
+        result = gitlab_tokens.lambda_handler(scanner=scanner)
+
+    groups, projects = set(), set()
+    for root in (2, 3):
+        root_groups, root_projects = fake.subtree(root)
+        groups.update(root_groups)
+        projects.update(root_projects)
+    assert result["status"] == "ok"
+    assert result["tokens_checked"] == fake.expected_expiring(root_groups=[2, 3])
+    assert fake.endpoint_counts["groups/:id/access_tokens"] == len(groups)
+    assert fake.endpoint_counts["projects/:id/access_tokens"] == len(projects)
+    assert "personal_access_tokens" not in fake.endpoint_counts
+    assert "projects" not in fake.endpoint_counts
+    subtrees = result["metrics"]["subtrees"]
+    assert set(subtrees) == {"group2", "group4", "group3"}
+    assert subtrees["group4"]["groups"] == subtrees["group4"]["projects"] == 0
+    assert sum(tree["groups"] for tree in subtrees.values()) == len(groups)
+    assert set(result["metrics"]["phases_s"]) == {"group_tree"}
+
+
+def test_deadline_suspends_and_resumes_through_sqs(tmp_path, monkeypatch):
+    sent = []
+    slack = MagicMock()
+    monkeypatch.setattr(gitlab_tokens, "CHECKPOINT_STORE", str(tmp_path))
+    monkeypatch.setattr(gitlab_tokens, "SQS_QUEUE_URL", "https://sqs.example/queue")
+    monkeypatch.setattr(gitlab_tokens, "send_message", lambda url, body, attributes=None: sent.append(json.loads(body)))
+    monkeypatch.setattr(gitlab_tokens, "send_message_batch", lambda url, bodies: sent.extend(map(json.loads, bodies)))
+    monkeypatch.setattr(gitlab_tokens, "send_slack_notification", slack)
+
+    monkeypatch.setattr(gitlab_tokens, "DENYLIST_FILE", str(tmp_path / "denylist.json"))
+
+    def run_until_done():
+        event, statuses = None, []
+        for _ in range(50):
+            result = gitlab_tokens.lambda_handler(event, CountdownContext(calls=40))
+            statuses.append(result["status"])
+            if result["status"] != "suspended":
+                return result, statuses
+            event = {"Records": [{"body": json.dumps(sent[-1])}]}
+
+    with FakeGitLab(projects=150, groups=40, personal_tokens=30, max_per_page=20) as fake:
+        fake.forbidden = {("projects", 7)}
+        point_at(fake, workers=4)
+        result, statuses = run_until_done()
+
+        assert statuses.count("suspended") >= 3
+        assert statuses[-1] == "ok"
+        assert slack.call_count == 1
+        summary, tokens = slack.call_args.args
+        assert summary["tokens_checked"] == fake.expected_expiring() == len(tokens)
+        assert [m["type"] for m in sent[:-1]] == ["resume"] * statuses.count("suspended")
+        assert not list((tmp_path / "runs").iterdir())
+        # Project 7 is denied in the first slice; the run that finishes later still saves it.
+        assert json.loads((tmp_path / "denylist.json").read_text()) == {"projects/7": mock.ANY}
+
+        sent.clear()
+        result, statuses = run_until_done()
+
+    assert statuses[-1] == "ok" and len(statuses) > 1
+    # Counters and phase timings cover every slice, not just the last invocation.
+    assert result["calls_skipped"] == 1
+    assert set(result["metrics"]["phases_s"]) >= {"project_tokens", "group_tokens"}
+
+
+def test_sharded_scan_with_local_queue(tmp_path, monkeypatch):
+    queue = gitlab_tokens.LocalQueue()
+    slack = MagicMock()
+    monkeypatch.setattr(gitlab_tokens, "sqs_client", queue)
+    monkeypatch.setattr(gitlab_tokens, "CHECKPOINT_STORE", str(tmp_path))
+    monkeypatch.setattr(gitlab_tokens, "SHARD_QUEUE_URL", "local")
+    monkeypatch.setattr(gitlab_tokens, "SHARD_SIZE", 40)
+    monkeypatch.setattr(gitlab_tokens, "send_slack_notification", slack)
+
+    with FakeGitLab(projects=130, groups=45, personal_tokens=25) as fake:
+        point_at(fake, workers=4)
+        coordinated = gitlab_tokens.lambda_handler({"mode": "sharded"})
+        results = queue.drain(gitlab_tokens.lambda_handler)
+
+    assert coordinated["shards"] == 1 + 4 + 2
+    statuses = [r["status"] for r in results]
+    assert statuses.count("shard_done") == coordinated["shards"]
+    assert statuses.count("ok") == 1
+    assert slack.call_count == 1
+    summary, tokens = slack.call_args.args
+    assert summary["tokens_checked"] == fake.expected_expiring() == len(tokens)
+    assert list((tmp_path / "runs" / coordinated["run_id"] / "parts").iterdir()) == []
+
+
+def test_sharded_runs_share_denylist_and_response_cache(tmp_path, monkeypatch):
+    queue = gitlab_tokens.LocalQueue()
+    monkeypatch.setattr(gitlab_tokens, "sqs_client", queue)
+    monkeypatch.setattr(gitlab_tokens, "CHECKPOINT_STORE", str(tmp_path / "state"))
+    monkeypatch.setattr(gitlab_tokens, "RESPONSE_CACHE", str(tmp_path / "cache"))
+    monkeypatch.setattr(gitlab_tokens, "SHARD_QUEUE_URL", "local")
+    monkeypatch.setattr(gitlab_tokens, "SHARD_SIZE", 40)
+    monkeypatch.setattr(gitlab_tokens, "send_slack_notification", MagicMock())
+
+    with FakeGitLab(projects=100, groups=20, personal_tokens=10) as fake:
+        fake.forbidden = {("projects", 7)}
+        point_at(fake, workers=4)
+        gitlab_tokens.lambda_handler({"mode": "sharded"})
+        queue.drain(gitlab_tokens.lambda_handler)
+        # One more project moves every shard boundary; the cache must still revalidate all the others.
+        fake.projects += 1
+        fake.request_count, fake.endpoint_counts = 0, {}
+        gitlab_tokens.lambda_handler({"mode": "sharded"})
+        queue.drain(gitlab_tokens.lambda_handler)
+
+    assert json.loads((tmp_path / "state" / "denylist.json").read_text()) == {"projects/7": mock.ANY}
+    assert fake.endpoint_counts["projects/:id/access_tokens"] == 100
+    assert fake.not_modified == 99 + 20
+
+
+def test_sharded_coordination_survives_an_instance_without_token(tmp_path, monkeypatch):
+    queue = gitlab_tokens.LocalQueue()
+    errors = MagicMock()
+    monkeypatch.setattr(gitlab_tokens, "sqs_client", queue)
+    monkeypatch.setattr(gitlab_tokens, "CHECKPOINT_STORE", str(tmp_path))
+    monkeypatch.setattr(gitlab_tokens, "SHARD_QUEUE_URL", "local")
+    monkeypatch.setattr(gitlab_tokens, "send_slack_error_notification", errors)
+    monkeypatch.setenv("ALPHA_TOKEN", "alpha-token")
+    monkeypatch.delenv("MISSING_TOKEN", raising=False)
+
+    with FakeGitLab(projects=20, groups=2, personal_tokens=5) as fake:
+        result = gitlab_tokens.handle_instances(gitlab_tokens.load_instances([
+            {"name": "broken", "url": "http://127.0.0.1:9", "token_env": "MISSING_TOKEN"},
+            {"name": "alpha", "url": fake.url, "token_env": "ALPHA_TOKEN", "rate_limit_rps": 0},
+        ]), {"mode": "sharded"})
+
+    assert [r["status"] for r in result["results"]] == ["error", "coordinated"]
+    assert "MISSING_TOKEN" in errors.call_args.args[0]
+
+
+def test_parallel_scan_merges_partitions_from_process_pool(monkeypatch):
+    slack = MagicMock()
+    monkeypatch.setattr(gitlab_tokens, "send_slack_notification", slack)
+
+    with FakeGitLab(projects=90, groups=20, personal_tokens=20) as fake:
+        scanner = point_at(fake, workers=2)
+        result = scanner.run_parallel_scan(processes=2, partition_size=25)
+
+    assert result["status"] == "ok"
+    assert result["partitions"] == 4 + 1
+    summary, tokens = slack.call_args.args
+    assert summary["tokens_checked"] == fake.expected_expiring() == len(tokens)
+    assert tokens[0].source.startswith("user")
+
+
+def test_parallel_scan_keeps_cache_checkpoint_and_metrics(tmp_path, monkeypatch):
+    monkeypatch.setattr(gitlab_tokens, "send_slack_notification", MagicMock())
+
+    with FakeGitLab(projects=60, groups=10, personal_tokens=10) as fake:
+        point_at(fake, workers=2)
+        results = []
+        for _ in range(2):
+            scanner = gitlab_tokens.TokenScanner(
+                checkpoint_store=str(tmp_path / "state"), response_cache=str(tmp_path / "cache")
+            )
+            fake.request_count = 0
+            results.append(scanner.run_parallel_scan(processes=2, partition_size=25))
+
+    first, second = results
+    assert second["metrics"]["requests"] == fake.request_count
+    assert second["metrics"]["endpoints"]["projects/:id/access_tokens"]["requests"] == 60
+    assert second["calls_skipped"] == 0
+    assert fake.not_modified == 60 + 10
+    checkpoint = json.loads((tmp_path / "state" / "checkpoint.json").read_text())
+    assert len(checkpoint["entities"]) == 60 + 10